@@ -1,6 +1,6 @@
 import torch
 from torch.utils.data import Dataset
-from pysmilesutils.augment import MolRandomizer, SMILESRandomizer
+from pysmilesutils.augment import MolRandomizer
 from pysmilesutils.datautils import BucketBatchSampler
 from molbart.tokeniser import MolEncTokeniser
 from molbart.util import DEFAULT_CHEM_TOKEN_START
@@ -10,29 +10,68 @@ from molbart.util import REGEX
 from rdkit import Chem
 import numpy as np
 import pandas
-from molbart.data.util import TokenSampler
-from megatron.data.samplers import DistributedBatchSampler
+from pathlib import Path
+from molbart.data.util import DistTokenSampler, mol_to_smiles, worker_init_fn
 from megatron import mpu
 import torch
 
-tokenizer = MolEncTokeniser.from_vocab_file(DEFAULT_VOCAB_PATH, REGEX,
-        DEFAULT_CHEM_TOKEN_START)
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pac
+except ImportError:
+    pa = None
+
 max_seq_len = 512
+aug = MolRandomizer()
+
+# Tokeniser shared by collate_fn, built once per process by _init_tok
+_TOK = None
+
+
+def _init_tok(worker_id=None, vocab_path=DEFAULT_VOCAB_PATH):
+    """ Build the shared tokeniser unless this process already has one
+
+    Used as the DataLoader worker_init_fn. Forked workers inherit the tokeniser built
+    in the main process, spawned workers build it once and keep it for the whole run
+    since the loaders use persistent workers.
+
+    Args:
+        worker_id (Optional[int]): DataLoader worker id, None when called from the main process
+        vocab_path (str): Path to vocab file
+
+    Returns:
+        MolEncTokeniser object
+    """
+
+    global _TOK
+    if worker_id is not None:
+        worker_init_fn(worker_id)
+
+    if _TOK is None:
+        _TOK = MolEncTokeniser.from_vocab_file(vocab_path, REGEX,
+                DEFAULT_CHEM_TOKEN_START)
+    return _TOK
 
 
 def check_seq_len(tokens, mask):
     """ Warn user and shorten sequence if the tokens are too long, otherwise return original
 
+    Token lists must already be padded, so the first sequence gives the length of the batch.
+    Arrays of token ids are expected in (seq_len, batch_size) order and are shortened with a single slice.
+
     Args:
-        tokens (List[List[str]]): List of token sequences
-        mask (List[List[int]]): List of mask sequences
+        tokens (List[List[str]] or np.ndarray): Padded token sequences or token ids
+        mask (List[List[int]] or np.ndarray): Mask sequences, in the same format as tokens
 
     Returns:
-        tokens (List[List[str]]): List of token sequences (shortened, if necessary)
-        mask (List[List[int]]): List of mask sequences (shortened, if necessary)
+        tokens (List[List[str]] or np.ndarray): Token sequences (shortened, if necessary)
+        mask (List[List[int]] or np.ndarray): Mask sequences (shortened, if necessary)
     """
 
-    seq_len = max([len(ts) for ts in tokens])
+    if isinstance(tokens, np.ndarray):
+        return (tokens[:max_seq_len], mask[:max_seq_len])
+
+    seq_len = len(tokens[0])
     if seq_len > max_seq_len:
         tokens_short = [ts[:max_seq_len] for ts in tokens]
         mask_short = [ms[:max_seq_len] for ms in mask]
@@ -40,84 +79,150 @@ def check_seq_len(tokens, mask):
     return (tokens, mask)
 
 
+def augment_mols(mols):
+    """ Randomise a batch of molecules and write them out as SMILES
+
+    Molecules which RDKit could not parse are given as their SMILES strings
+    and are returned without augmentation.
+
+    Args:
+        mols (List[Union[Chem.Mol, str]]): Batch of molecules
+
+    Returns:
+        smiles (List[str]): Randomised SMILES strings, one per molecule
+    """
+
+    idxs = [idx for (idx, mol) in enumerate(mols) if not isinstance(mol, str)]
+    if len(idxs) == len(mols):
+        return list(map(mol_to_smiles, aug(mols), mols))
+
+    smiles = list(mols)
+    parsed = [mols[idx] for idx in idxs]
+    if len(parsed) > 0:
+        for (idx, smi) in zip(idxs, map(mol_to_smiles, aug(parsed), parsed)):
+            smiles[idx] = smi
+    return smiles
+
+
 def collate_fn(batch):
-    """ Used by DataLoader to concatenate/collate inputs."""
-
-    encoder_smiles = [x['encoder_smiles'][0] for x in batch]
-    decoder_smiles = [x['decoder_smiles'][0] for x in batch]
-    enc_token_output = tokenizer.tokenise(encoder_smiles, mask=True,
-            pad=True)
-    dec_token_output = tokenizer.tokenise(decoder_smiles, pad=True)
-
-    enc_mask = enc_token_output['pad_masks']
-    enc_tokens = enc_token_output['masked_tokens']
-    dec_tokens = dec_token_output['original_tokens']
-    dec_mask = dec_token_output['pad_masks']
-
-    (enc_tokens, enc_mask) = check_seq_len(enc_tokens, enc_mask)
-    (dec_tokens, dec_mask) = check_seq_len(dec_tokens, dec_mask)
-
-    enc_token_ids = tokenizer.convert_tokens_to_ids(enc_tokens)
-    dec_token_ids = tokenizer.convert_tokens_to_ids(dec_tokens)
-    enc_token_ids = torch.tensor(enc_token_ids).transpose(0, 1)
-    enc_pad_mask = torch.tensor(enc_mask,
-                                dtype=torch.int64).transpose(0, 1)
-    dec_token_ids = torch.tensor(dec_token_ids).transpose(0, 1)
-    dec_pad_mask = torch.tensor(dec_mask,
-                                dtype=torch.int64).transpose(0, 1)
+    """ Used by DataLoader to concatenate/collate inputs.
+
+    The batch is either a list of molecules, which are augmented, or a list of SMILES
+    strings from a dataset without augmentation, which are used as they are.
+    A batch of molecules may also contain the SMILES strings of molecules RDKit could not parse.
+    """
+
+    if all(isinstance(mol, str) for mol in batch):
+        encoder_smiles = decoder_smiles = list(batch)
+    else:
+        encoder_smiles = augment_mols(batch)
+        decoder_smiles = augment_mols(batch)
+
+    # Ids are written in (seq_len, batch_size) order so no transpose is needed
+    enc_token_output = _TOK.tokenise_ids(encoder_smiles, mask=True,
+            batch_first=False)
+
+    enc_pad_mask = enc_token_output['pad_masks']
+    enc_token_ids = enc_token_output['masked_ids']
+
+    (enc_token_ids, enc_pad_mask) = check_seq_len(enc_token_ids, enc_pad_mask)
+    (dec_token_ids, dec_pad_mask) = \
+        _TOK.tokenise_to_ids(decoder_smiles, batch_first=False)
+    (dec_token_ids, dec_pad_mask) = check_seq_len(dec_token_ids, dec_pad_mask)
+
+    # All batch tensors are broadcast as int64, so the masks are not kept as bool
+    enc_token_ids = torch.from_numpy(enc_token_ids)
+    enc_pad_mask = torch.from_numpy(enc_pad_mask.astype(np.int64))
+    dec_token_ids = torch.from_numpy(dec_token_ids)
+    dec_pad_mask = torch.from_numpy(dec_pad_mask.astype(np.int64))
 
     collate_output = {
         'encoder_input': enc_token_ids,
         'encoder_pad_mask': enc_pad_mask,
         'decoder_input': dec_token_ids[:-1, :],
         'decoder_pad_mask': dec_pad_mask[:-1, :],
-        'target': dec_token_ids.clone()[1:, :],
-        'target_pad_mask': dec_pad_mask.clone()[1:, :],
+        'target': dec_token_ids[1:, :],
+        'target_pad_mask': dec_pad_mask[1:, :],
         'target_smiles': decoder_smiles,
         }
 
     return collate_output
 
 
+def read_csv_data(file_path):
+    """ Read molecule data from a csv file or a directory of csv files
+
+    pyarrow's multithreaded csv parser is used when it is installed, the tables for each
+    file are concatenated before converting to pandas so the frames are not copied twice.
+    Falls back to pandas otherwise.
+
+    Args:
+        file_path (str): Path to a csv file or a directory containing csv files
+
+    Returns:
+        df (pandas.DataFrame): DataFrame with the rows of all files
+    """
+
+    path = Path(file_path)
+    files = sorted(path.glob('*.csv')) if path.is_dir() else [path]
+
+    if pa is None:
+        dfs = [pandas.read_csv(f) for f in files]
+        return pandas.concat(dfs, ignore_index=True, copy=False)
+
+    read_options = pac.ReadOptions(use_threads=True)
+    tables = [pac.read_csv(f, read_options=read_options) for f in files]
+    table = pa.concat_tables(tables)
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
 class MoleculeDataset(Dataset):
 
-    """Simple Molecule dataset that reads from a single DataFrame."""
+    """Simple Molecule dataset that reads from a single DataFrame.
+
+    The SMILES strings are stored packed into a single bytes buffer with an array of offsets,
+    rather than as a list of Python strings, to keep the memory overhead per molecule small.
+    """
 
-    def __init__(self, df, split='train'):
+    def __init__(self, df, split='train', augment=True):
         """
         Args:
-            df (pandas.DataFrame): DataFrame object with RDKit molecules and lengths.
+            df (pandas.DataFrame): DataFrame object with SMILES strings and lengths.
+            split (str): Which set to use, rows not in 'val' or 'test' are used for 'train'
+            augment (bool): Return molecules for augmentation, otherwise the canonical SMILES
+                strings are returned and RDKit is not used at all. SMILES strings RDKit
+                cannot parse are returned as strings either way
         """
 
-        self.mols = df['canonical_smiles'].tolist()
-        self.lengths = df['lengths'].tolist()
-        self.aug = SMILESRandomizer()
-        val_idxs = df.index[df['set'] == 'val'].tolist()
-        test_idxs = df.index[df['set'] == 'test'].tolist()
-        idxs = set(range(len(df.index)))
-        train_idxs = idxs - set(val_idxs).union(set(test_idxs))
-        idx_map = {'train': train_idxs, 'val': val_idxs,
-                   'test': test_idxs}
-        self.mols = [self.mols[idx] for idx in idx_map[split]]
-        self.lengths = [self.lengths[idx] for idx in idx_map[split]]
+        self.augment = augment
+
+        sets = df['set'].values
+        if split == 'train':
+            split_mask = (sets != 'val') & (sets != 'test')
+        else:
+            split_mask = sets == split
+        idxs = np.flatnonzero(split_mask)
+
+        smiles = [smi.encode() for smi in df['canonical_smiles'].values[idxs]]
+        self._buf = b''.join(smiles)
+        self._off = np.zeros(len(smiles) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, smiles), dtype=np.int64,
+                  count=len(smiles)), out=self._off[1:])
+        self.lengths = df['lengths'].values[idxs]
 
     def __len__(self):
-        return len(self.mols)
+        return len(self._off) - 1
 
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
-        mol = self.mols[idx]
-        try:
-            enc_smi = self.aug(mol)
-        except:
-            enc_smi = mol
-        try:
-            dec_smi = self.aug(mol)
-        except:
-            dec_smi = mol
-        output = {'encoder_smiles': enc_smi, 'decoder_smiles': dec_smi}
-        return output
+        smi = self._buf[self._off[idx]:self._off[idx + 1]].decode()
+        if not self.augment:
+            return smi
+
+        # SMILES which RDKit cannot parse are returned as they are and are not augmented
+        mol = Chem.MolFromSmiles(smi)
+        return smi if mol is None else mol
 
 
 class MoleculeDataLoader(object):
@@ -130,30 +235,70 @@ class MoleculeDataLoader(object):
         batch_size=32,
         num_buckets=20,
         num_workers=32,
+        shuffle=True,
+        token_batch_size=None,
+        augment=True,
+        augment_val=True,
         ):
+        """
+        Args:
+            file_path (str): Path to a csv file or a directory of csv files
+            batch_size (int): Number of molecules in each batch
+            num_buckets (int): Number of length buckets, used with token_batch_size
+            num_workers (int): Number of DataLoader worker processes
+            shuffle (bool): Shuffle the training data each epoch
+            token_batch_size (Optional[int]): Target number of tokens in each training batch,
+                batches of similar length molecules are used instead of batch_size if given
+            augment (bool): Randomise the SMILES of the training molecules
+            augment_val (bool): Randomise the SMILES of the validation molecules
+        """
 
-        self.df = pandas.read_csv(file_path)
-        train_dataset = MoleculeDataset(self.df, split='train')
-        val_dataset = MoleculeDataset(self.df, split='val')
-        self.tokenizer = \
-            MolEncTokeniser.from_vocab_file(DEFAULT_VOCAB_PATH, REGEX,
-                DEFAULT_CHEM_TOKEN_START)
+        # The data is read once and only the packed SMILES are kept by the datasets,
+        # the DataFrame is not held on to so forked workers do not inherit it
+        df = read_csv_data(file_path)
+        train_dataset = MoleculeDataset(df, split='train',
+                augment=augment)
+        val_dataset = MoleculeDataset(df, split='val',
+                augment=augment_val)
+        del df
+        self.tokenizer = _init_tok()
 
         world_size = \
             torch.distributed.get_world_size(group=mpu.get_data_parallel_group())
         rank = \
             torch.distributed.get_rank(group=mpu.get_data_parallel_group())
-        sampler = torch.utils.data.SequentialSampler(train_dataset)
-        batch_sampler = DistributedBatchSampler(sampler, batch_size,
-                True, rank, world_size)
+        if token_batch_size is not None:
+            self.train_sampler = DistTokenSampler(num_buckets,
+                    train_dataset.lengths, token_batch_size, rank,
+                    world_size, shuffle=shuffle)
+            batch_sampler = self.train_sampler
+        else:
+            # The sampler pads the last few indices by wrapping around, so the
+            # number of batches is the same on every rank
+            self.train_sampler = torch.utils.data.DistributedSampler(train_dataset,
+                    num_replicas=world_size, rank=rank, shuffle=shuffle)
+            batch_sampler = torch.utils.data.BatchSampler(self.train_sampler,
+                    batch_size, drop_last=True)
 
         self.train_loader = torch.utils.data.DataLoader(train_dataset,
                 batch_sampler=batch_sampler, num_workers=num_workers,
-                pin_memory=True, collate_fn=collate_fn)
+                pin_memory=True, collate_fn=collate_fn,
+                persistent_workers=num_workers > 0,
+                worker_init_fn=_init_tok)
         self.val_loader = torch.utils.data.DataLoader(val_dataset,
                 num_workers=num_workers, pin_memory=True,
-                collate_fn=collate_fn)
+                collate_fn=collate_fn,
+                persistent_workers=num_workers > 0,
+                worker_init_fn=_init_tok)
 
     def get_data(self):
         return (self.train_loader, self.val_loader)
 
+    def set_epoch(self, epoch):
+        """ Set the epoch used to seed the shuffle of the training data
+
+        Must be called with the same epoch on every rank before iterating over the train loader.
+        """
+
+        self.train_sampler.set_epoch(epoch)
+
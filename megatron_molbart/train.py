@@ -16,6 +16,7 @@ from megatron_bart import MegatronBART
 from molbart.decoder import DecodeSampler
 import deepspeed
 from csv_data import MoleculeDataLoader
+from molbart.data.util import PrefetchLoader
 from megatron import get_args
 import numpy as np
 import pickle
@@ -33,14 +34,18 @@ epochs = 0
 
 class RepeatingLoader:
 
-    def __init__(self, loader):
+    def __init__(self, loader, set_epoch=None):
         """Wraps an iterator to allow for infinite iteration. This is especially useful
         for DataLoader types that we wish to automatically restart upon completion.
         Args:
             loader (iterator): The data loader to repeat.
+            set_epoch (Optional[Callable[[int], None]]): Called with the new epoch number
+                before the loader is restarted.
         """
 
         self.loader = loader
+        self.set_epoch = set_epoch
+        self.epoch = 0
         self.data_iter = iter(self.loader)
 
     def __iter__(self):
@@ -52,6 +57,9 @@ class RepeatingLoader:
         try:
             batch = next(self.data_iter)
         except StopIteration:
+            self.epoch += 1
+            if self.set_epoch is not None:
+                self.set_epoch(self.epoch)
             self.data_iter = iter(self.loader)
             batch = next(self.data_iter)
             if torch.distributed.get_rank() == 0:
@@ -180,6 +188,10 @@ def get_batch(data_iterator):
         ]
     datatype = torch.int64
     data = next(data_iterator)
+
+    # Batches come from pinned memory, so they can be copied to the GPU without blocking.
+    # broadcast_data would otherwise concatenate them into a new pageable tensor before copying
+    data = {key: data[key].cuda(non_blocking=True) for key in keys}
     data_b = mpu.broadcast_data(keys, data, datatype)
 
     # Unpack.
@@ -375,7 +387,8 @@ def run_training(ckpt_dir='megatron_molbart_checkpoint'):
     if ckpt_dir is not None:
         model.load_checkpoint(ckpt_dir)
     print_rank_0('Starting training ...')
-    train_dataloader = RepeatingLoader(train_dataloader)
+    train_dataloader = RepeatingLoader(PrefetchLoader(train_dataloader),
+                                       set_epoch=loader.set_epoch)
     val_dataloader = RepeatingLoader(val_dataloader)
 
     train(
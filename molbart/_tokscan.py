@@ -0,0 +1,209 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+# The regex the scanner reproduces, the same as molbart.util.REGEX
+REGEX = r"\[[^\]]+]|Br?|Cl?|[NOSPFIbcnops()=#\-+\\/:~@?>*$.]|\%[0-9]{2}|[0-9]"
+
+# Earlier spelling of REGEX with each single character token as its own alternative, matches the same tokens
+LEGACY_REGEX = r"\[[^\]]+]|Br?|Cl?|N|O|S|P|F|I|b|c|n|o|s|p|\(|\)|\.|=|#|-|\+|\\|\/|:|~|@|\?|>|\*|\$|\%[0-9]{2}|[0-9]"
+
+# Smallest number of SMILES strings given to each thread
+MIN_CHUNK_SIZE = 256
+
+# Id given to tokens which must be looked up in the vocab from Python (bracket atoms and unknown tokens)
+RESOLVE_ID = -2
+
+# MolEncTokeniser._get_compiled_regex only escapes ()[].| so extra tokens containing any other
+# regex syntax are not matched literally
+_REGEX_CHARS = "\\^$*+?{}"
+
+
+def _scan_loop(codes, str_ends, char_ids, br_id, cl_id, pct_ids, ext_codes, ext_offsets, ext_ids, ext_groups):
+    num_codes = len(codes)
+    ids = np.empty(num_codes, dtype=np.int64)
+    starts = np.empty(num_codes, dtype=np.int64)
+    ends = np.empty(num_codes, dtype=np.int64)
+    lengths = np.zeros(len(str_ends), dtype=np.int64)
+
+    num_tokens = 0
+    pos = 0
+    for str_idx in range(len(str_ends)):
+        str_end = str_ends[str_idx]
+        first_token = num_tokens
+        while pos < str_end:
+            code = codes[pos]
+            token_end = pos + 1
+            token_id = RESOLVE_ID
+
+            # Extra tokens are tried first and in order, the first one matching wins. Only the extra tokens
+            # starting with this character can match, which are stored together
+            ext_match = False
+            group = min(code, 128)
+            if ext_groups[group] < ext_groups[group + 1]:
+                for ext_idx in range(ext_groups[group], ext_groups[group + 1]):
+                    ext_start = ext_offsets[ext_idx]
+                    ext_len = ext_offsets[ext_idx + 1] - ext_start
+                    if pos + ext_len > str_end:
+                        continue
+
+                    ext_match = True
+                    for offset in range(ext_len):
+                        if codes[pos + offset] != ext_codes[ext_start + offset]:
+                            ext_match = False
+                            break
+
+                    if ext_match:
+                        token_end = pos + ext_len
+                        token_id = ext_ids[ext_idx]
+                        break
+
+            if not ext_match:
+                # [ starts a bracket atom running to the next ], if there is one and it is not empty
+                if code == 91:
+                    close = pos + 1
+                    while close < str_end and codes[close] != 93:
+                        close += 1
+                    if close < str_end and close > pos + 1:
+                        token_end = close + 1
+                    else:
+                        token_id = char_ids[code]
+
+                # Newlines are not matched by . so are skipped
+                elif code == 10:
+                    pos = token_end
+                    continue
+
+                elif code == 66 and token_end < str_end and codes[token_end] == 114:
+                    token_end += 1
+                    token_id = br_id
+
+                elif code == 67 and token_end < str_end and codes[token_end] == 108:
+                    token_end += 1
+                    token_id = cl_id
+
+                elif (code == 37 and token_end + 1 < str_end
+                      and 48 <= codes[token_end] <= 57 and 48 <= codes[token_end + 1] <= 57):
+                    token_id = pct_ids[(codes[token_end] - 48) * 10 + codes[token_end + 1] - 48]
+                    token_end += 2
+
+                elif code < 128:
+                    token_id = char_ids[code]
+
+            ids[num_tokens] = token_id
+            starts[num_tokens] = pos
+            ends[num_tokens] = token_end
+            num_tokens += 1
+            pos = token_end
+
+        lengths[str_idx] = num_tokens - first_token
+
+    return ids[:num_tokens], starts[:num_tokens], ends[:num_tokens], lengths
+
+
+_scan = None if njit is None else njit(nogil=True, cache=True)(_scan_loop)
+
+
+def build_scan_tables(vocab, extra_tokens):
+    """ Build the lookup tables used by scan_ids for a vocab
+
+    Args:
+        vocab (Dict[str, int]): Mapping from token to id
+        extra_tokens (List[str]): Extra tokens compiled into the regex before REGEX
+
+    Returns:
+        Tuple of arrays and ids passed to scan_ids, or None if numba is not available
+        or the extra tokens cannot be matched literally
+    """
+
+    if _scan is None:
+        return None
+
+    for token in extra_tokens:
+        if token == "" or any(char in _REGEX_CHARS for char in token):
+            return None
+
+    char_ids = np.full(128, RESOLVE_ID, dtype=np.int64)
+    for code in range(128):
+        char_ids[code] = vocab.get(chr(code), RESOLVE_ID)
+
+    pct_ids = np.array([vocab.get(f"%{num:02d}", RESOLVE_ID) for num in range(100)], dtype=np.int64)
+
+    # Extra tokens are grouped by first character, keeping their order within each group,
+    # with every non-ASCII first character sharing the last group
+    extra_tokens = sorted(extra_tokens, key=lambda token: min(ord(token[0]), 128))
+    ext_codes = [_to_codes(token) for token in extra_tokens]
+    ext_offsets = np.zeros(len(ext_codes) + 1, dtype=np.int64)
+    ext_offsets[1:] = np.cumsum([len(codes) for codes in ext_codes])
+    ext_ids = np.array([vocab.get(token, RESOLVE_ID) for token in extra_tokens], dtype=np.int64)
+
+    # Extra tokens in group g run from ext_groups[g] to ext_groups[g + 1]
+    ext_firsts = [min(ord(token[0]), 128) for token in extra_tokens]
+    ext_groups = np.searchsorted(ext_firsts, np.arange(130)).astype(np.int64)
+
+    flat_ext_codes = np.concatenate(ext_codes) if ext_codes else np.empty(0, dtype=np.uint32)
+    return (
+        char_ids,
+        vocab.get("Br", RESOLVE_ID),
+        vocab.get("Cl", RESOLVE_ID),
+        pct_ids,
+        flat_ext_codes,
+        ext_offsets,
+        ext_ids,
+        ext_groups
+    )
+
+
+def scan_ids(smiles, tables, num_threads=1):
+    """ Split a batch of SMILES strings into tokens the same way as REGEX and look up their ids
+
+    The scanner releases the GIL, so with num_threads > 1 a large batch is split into chunks which are
+    scanned in parallel.
+
+    Args:
+        smiles (List[str]): Batch of SMILES strings
+        tables (Tuple): Lookup tables from build_scan_tables
+        num_threads (int): Maximum number of threads to scan with
+
+    Returns:
+        ids (np.ndarray): Id of each token, RESOLVE_ID for tokens which must be looked up from Python
+        starts (np.ndarray): Start of each token in the joined SMILES string
+        ends (np.ndarray): End of each token in the joined SMILES string
+        lengths (np.ndarray): Number of tokens in each SMILES string
+        joined (str): All SMILES strings joined together
+    """
+
+    joined = "".join(smiles)
+    codes = _to_codes(joined)
+    str_ends = np.cumsum(np.fromiter(map(len, smiles), dtype=np.int64, count=len(smiles)))
+
+    num_chunks = min(num_threads, len(smiles) // MIN_CHUNK_SIZE)
+    if num_chunks <= 1:
+        ids, starts, ends, lengths = _scan(codes, str_ends, *tables)
+        return ids, starts, ends, lengths, joined
+
+    # Each chunk is scanned as if its strings were the whole batch, then moved back to its offset
+    chunk_bounds = np.linspace(0, len(smiles), num_chunks + 1).astype(np.int64)
+    code_offsets = [0 if idx == 0 else str_ends[idx - 1] for idx in chunk_bounds[:-1]]
+
+    def scan_chunk(chunk_idx):
+        offset = code_offsets[chunk_idx]
+        chunk_ends = str_ends[chunk_bounds[chunk_idx]:chunk_bounds[chunk_idx + 1]]
+        ids, starts, ends, lengths = _scan(codes[offset:chunk_ends[-1]], chunk_ends - offset, *tables)
+        return ids, starts + offset, ends + offset, lengths
+
+    # Threads are only started for batches large enough to split, so they are not kept between calls
+    with ThreadPoolExecutor(max_workers=num_chunks) as executor:
+        chunks = list(executor.map(scan_chunk, range(num_chunks)))
+
+    ids, starts, ends, lengths = [np.concatenate(outputs) for outputs in zip(*chunks)]
+    return ids, starts, ends, lengths, joined
+
+
+def _to_codes(string):
+    return np.frombuffer(string.encode("utf-32-le"), dtype=np.uint32)
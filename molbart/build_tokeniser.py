@@ -10,7 +10,7 @@ from molbart.data.datasets import Chembl, MolOptDataset
 MOL_OPT_TOKENS_PATH = "mol_opt_tokens.txt"
 PROP_PRED_TOKENS_PATH = "prop_pred_tokens.txt"
 NUM_UNUSED_TOKENS = 200
-REGEX = "\[[^\]]+]|Br?|Cl?|N|O|S|P|F|I|b|c|n|o|s|p|\(|\)|\.|=|#|-|\+|\\\\|\/|:|~|@|\?|>|\*|\$|\%[0-9]{2}|[0-9]"
+REGEX = r"\[[^\]]+]|Br?|Cl?|[NOSPFIbcnops()=#\-+\\/:~@?>*$.]|\%[0-9]{2}|[0-9]"
 
 
 def build_mol_dataset(args):
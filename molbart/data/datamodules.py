@@ -1,14 +1,15 @@
 import torch
-import multiprocessing
+import numpy as np
 import pytorch_lightning as pl
 from rdkit import Chem
+from pathlib import Path
 from functools import partial
 from typing import List, Optional
 from torch.utils.data import DataLoader
 from pysmilesutils.augment import MolRandomizer
 
 from molbart.tokeniser import MolEncTokeniser
-from molbart.data.util import TokenSampler
+from molbart.data.util import TokenSampler, default_num_workers, mol_to_smiles, worker_init_fn
 from molbart.data.datasets import MoleculeDataset, ReactionDataset
 
 
@@ -49,7 +50,10 @@ class _AbsDataModule(pl.LightningDataModule):
         self.test_idxs = test_idxs
         self.split_perc = split_perc
 
-        self._num_workers = multiprocessing.cpu_count()
+        self._num_workers = default_num_workers()
+        self._pin_memory = torch.cuda.is_available()
+        self._persistent_workers = True
+        self._prefetch_factor = 4
 
         self.train_dataset = None
         self.val_dataset = None
@@ -63,7 +67,8 @@ class _AbsDataModule(pl.LightningDataModule):
                 batch_size=self.batch_size,
                 num_workers=self._num_workers, 
                 collate_fn=self._collate,
-                shuffle=True
+                shuffle=True,
+                **self._loader_kwargs()
             )
             return loader
 
@@ -77,7 +82,8 @@ class _AbsDataModule(pl.LightningDataModule):
             self.train_dataset,
             batch_sampler=sampler,
             num_workers=self._num_workers,
-            collate_fn=self._collate
+            collate_fn=self._collate,
+            **self._loader_kwargs()
         )
         return loader
 
@@ -86,7 +92,8 @@ class _AbsDataModule(pl.LightningDataModule):
             self.val_dataset, 
             batch_size=self.batch_size,
             num_workers=self._num_workers, 
-            collate_fn=partial(self._collate, train=False)
+            collate_fn=partial(self._collate, train=False),
+            **self._loader_kwargs()
         )
         return loader
 
@@ -95,10 +102,27 @@ class _AbsDataModule(pl.LightningDataModule):
             self.test_dataset, 
             batch_size=self.batch_size,
             num_workers=self._num_workers, 
-            collate_fn=partial(self._collate, train=False)
+            collate_fn=partial(self._collate, train=False),
+            **self._loader_kwargs()
         )
         return loader
 
+    def _loader_kwargs(self):
+        """ DataLoader options shared by the train, val and test loaders
+
+        Pinned batches allow asynchronous host to device copies, so batches are only pinned when a GPU
+        is available. Persistent workers are kept alive between epochs rather than being restarted each time.
+        Worker-only options are left out when loading in the main process.
+        """
+
+        kwargs = {"pin_memory": self._pin_memory}
+        if self._num_workers > 0:
+            kwargs["persistent_workers"] = self._persistent_workers
+            kwargs["prefetch_factor"] = self._prefetch_factor
+            kwargs["worker_init_fn"] = worker_init_fn
+
+        return kwargs
+
     def setup(self, stage=None):
         train_dataset = None
         val_dataset = None
@@ -122,19 +146,26 @@ class _AbsDataModule(pl.LightningDataModule):
     def _check_seq_len(self, tokens, mask):
         """ Warn user and shorten sequence if the tokens are too long, otherwise return original
 
+        Token lists must already be padded, so the first sequence gives the length of the batch.
+        Arrays of token ids are expected in (seq_len, batch_size) order and are shortened with a single slice.
+
         Args:
-            tokens (List[List[str]]): List of token sequences
-            mask (List[List[int]]): List of mask sequences
+            tokens (List[List[str]] or np.ndarray): Padded token sequences or token ids
+            mask (List[List[int]] or np.ndarray): Mask sequences, in the same format as tokens
 
         Returns:
-            tokens (List[List[str]]): List of token sequences (shortened, if necessary)
-            mask (List[List[int]]): List of mask sequences (shortened, if necessary)
+            tokens (List[List[str]] or np.ndarray): Token sequences (shortened, if necessary)
+            mask (List[List[int]] or np.ndarray): Mask sequences (shortened, if necessary)
         """
 
-        seq_len = max([len(ts) for ts in tokens])
+        is_array = isinstance(tokens, np.ndarray)
+        seq_len = tokens.shape[0] if is_array else len(tokens[0])
         if seq_len > self.max_seq_len:
             print(f"WARNING -- Sequence length {seq_len} is larger than maximum sequence size")
 
+            if is_array:
+                return tokens[:self.max_seq_len], mask[:self.max_seq_len]
+
             tokens_short = [ts[:self.max_seq_len] for ts in tokens]
             mask_short = [ms[:self.max_seq_len] for ms in mask]
 
@@ -155,7 +186,8 @@ class MoleculeDataModule(_AbsDataModule):
         val_idxs: Optional[List[int]] = None, 
         test_idxs: Optional[List[int]] = None,
         split_perc: Optional[float] = 0.2,
-        augment: Optional[bool] = True 
+        augment: Optional[bool] = True,
+        token_cache_dir: Optional[str] = None
     ):
         super(MoleculeDataModule, self).__init__(
             dataset,
@@ -176,29 +208,81 @@ class MoleculeDataModule(_AbsDataModule):
             print("No molecular augmentation.")
             self.aug = None
 
+        self.token_cache_dir = token_cache_dir
+
+    def setup(self, stage=None):
+        super(MoleculeDataModule, self).setup(stage)
+
+        # Without augmentation every epoch sees the same canonical SMILES, so tokenise them once up front.
+        # The ids of each split are cached in their own directory under token_cache_dir, if it is given.
+        # The loader workers have not been started yet, so their share of the CPUs is used to scan the SMILES
+        if self.aug is None:
+            num_threads = max(1, self._num_workers)
+            splits = {"train": self.train_dataset, "val": self.val_dataset, "test": self.test_dataset}
+            for split, dataset in splits.items():
+                cache_dir = Path(self.token_cache_dir) / split if self.token_cache_dir is not None else None
+                dataset.precompute_ids(self.tokeniser, cache_dir=cache_dir, num_threads=num_threads)
+
     def _collate(self, batch, train=True):
+        if isinstance(batch[0], np.ndarray):
+            return self._collate_ids(batch, train)
+
         token_output = self._prepare_tokens(batch, train)
-        enc_tokens = token_output["encoder_tokens"]
+        enc_token_ids = token_output["encoder_ids"]
         enc_pad_mask = token_output["encoder_pad_mask"]
-        dec_tokens = token_output["decoder_tokens"]
-        dec_pad_mask = token_output["decoder_pad_mask"]
         target_smiles = token_output["target_smiles"]
 
-        enc_token_ids = self.tokeniser.convert_tokens_to_ids(enc_tokens)
-        dec_token_ids = self.tokeniser.convert_tokens_to_ids(dec_tokens)
+        # Ids are written in (seq_len, batch_size) order, so slicing the sequence dimension gives contiguous views
+        dec_token_ids, dec_pad_mask = self.tokeniser.tokenise_to_ids(target_smiles, batch_first=False)
+        dec_token_ids, dec_pad_mask = self._check_seq_len(dec_token_ids, dec_pad_mask)
+
+        enc_token_ids = torch.from_numpy(enc_token_ids)
+        enc_pad_mask = torch.from_numpy(enc_pad_mask)
+        dec_token_ids = torch.from_numpy(dec_token_ids)
+        dec_pad_mask = torch.from_numpy(dec_pad_mask)
+
+        collate_output = {
+            "encoder_input": enc_token_ids,
+            "encoder_pad_mask": enc_pad_mask,
+            "decoder_input": dec_token_ids[:-1, :],
+            "decoder_pad_mask": dec_pad_mask[:-1, :],
+            "target": dec_token_ids[1:, :],
+            "target_pad_mask": dec_pad_mask[1:, :],
+            "target_smiles": target_smiles
+        }
+
+        return collate_output
+
+    def _collate_ids(self, batch, train):
+        """ Collate token ids precomputed by MoleculeDataset.precompute_ids
+
+        Neither RDKit nor the tokenising regex is used, the decoder ids are taken directly from the dataset
+        and the encoder input for training is made by masking those ids.
+        """
+
+        target_smiles = self.tokeniser.detokenise(self.tokeniser.convert_ids_to_tokens(batch))
+
+        dec_token_ids, dec_pad_mask = self.tokeniser.pad_id_array(batch, batch_first=False)
+        dec_token_ids, dec_pad_mask = self._check_seq_len(dec_token_ids, dec_pad_mask)
 
-        enc_token_ids = torch.tensor(enc_token_ids).transpose(0, 1)
-        enc_pad_mask = torch.tensor(enc_pad_mask, dtype=torch.bool).transpose(0, 1)
-        dec_token_ids = torch.tensor(dec_token_ids).transpose(0, 1)
-        dec_pad_mask = torch.tensor(dec_pad_mask, dtype=torch.bool).transpose(0, 1)
+        if train:
+            enc_token_ids, enc_pad_mask = self.tokeniser.mask_id_array(batch, batch_first=False)
+            enc_token_ids, enc_pad_mask = self._check_seq_len(enc_token_ids, enc_pad_mask)
+        else:
+            enc_token_ids, enc_pad_mask = dec_token_ids, dec_pad_mask
+
+        enc_token_ids = torch.from_numpy(enc_token_ids)
+        enc_pad_mask = torch.from_numpy(enc_pad_mask)
+        dec_token_ids = torch.from_numpy(dec_token_ids)
+        dec_pad_mask = torch.from_numpy(dec_pad_mask)
 
         collate_output = {
             "encoder_input": enc_token_ids,
             "encoder_pad_mask": enc_pad_mask,
             "decoder_input": dec_token_ids[:-1, :],
             "decoder_pad_mask": dec_pad_mask[:-1, :],
-            "target": dec_token_ids.clone()[1:, :],
-            "target_pad_mask": dec_pad_mask.clone()[1:, :],
+            "target": dec_token_ids[1:, :],
+            "target_pad_mask": dec_pad_mask[1:, :],
             "target_smiles": target_smiles
         }
 
@@ -213,48 +297,25 @@ class MoleculeDataModule(_AbsDataModule):
             encoder_mols = batch[:]
             decoder_mols = batch[:]
 
-        canonical = self.aug is None
-        enc_smiles = []
-        dec_smiles = []
-
-        # There is a very rare possibility that RDKit will not be able to generate the SMILES for the augmented mol
-        # In this case we just use the canonical mol to generate the SMILES
-        for idx, (enc_mol, dec_mol) in enumerate(zip(encoder_mols, decoder_mols)):
-            try:
-                enc_smi = Chem.MolToSmiles(enc_mol, canonical=canonical)
-            except RuntimeError:
-                enc_smi = Chem.MolToSmiles(batch[idx], canonical=True)
-                print(f"Could not generate smiles after augmenting: {enc_smi}")
-
-            try:
-                dec_smi = Chem.MolToSmiles(dec_mol, canonical=canonical)
-            except RuntimeError:
-                dec_smi = Chem.MolToSmiles(batch[idx], canonical=True)
-                print(f"Could not generate smiles after augmenting: {dec_smi}")
+        to_smiles = partial(mol_to_smiles, canonical=self.aug is None)
+        enc_smiles = list(map(to_smiles, encoder_mols, batch))
+        dec_smiles = list(map(to_smiles, decoder_mols, batch))
 
-            enc_smiles.append(enc_smi)
-            dec_smiles.append(dec_smi)
-
-        enc_token_output = self.tokeniser.tokenise(enc_smiles, mask=True, pad=True)
-        dec_token_output = self.tokeniser.tokenise(dec_smiles, pad=True)
+        # Encoder tokens are only masked for training
+        enc_token_output = self.tokeniser.tokenise_ids(enc_smiles, mask=train, batch_first=False)
 
         enc_mask = enc_token_output["pad_masks"]
         if train:
-            enc_tokens = enc_token_output["masked_tokens"]
+            enc_ids = enc_token_output["masked_ids"]
         else:
-            enc_tokens = enc_token_output["original_tokens"]
-
-        dec_tokens = dec_token_output["original_tokens"]
-        dec_mask = dec_token_output["pad_masks"]
+            enc_ids = enc_token_output["original_ids"]
 
-        enc_tokens, enc_mask = self._check_seq_len(enc_tokens, enc_mask)
-        dec_tokens, dec_mask = self._check_seq_len(dec_tokens, dec_mask)
+        enc_ids, enc_mask = self._check_seq_len(enc_ids, enc_mask)
 
+        # The decoder SMILES are tokenised straight to ids in _collate
         token_output = {
-            "encoder_tokens": enc_tokens,
+            "encoder_ids": enc_ids,
             "encoder_pad_mask": enc_mask,
-            "decoder_tokens": dec_tokens,
-            "decoder_pad_mask": dec_mask,
             "target_smiles": dec_smiles
         }
 
@@ -305,27 +366,20 @@ class FineTuneReactionDataModule(_AbsDataModule):
         # TODO Allow both forward and backward prediction
 
         token_output = self._prepare_tokens(batch, train)
-        reacts_tokens = token_output["reacts_tokens"]
-        reacts_mask = token_output["reacts_mask"]
-        prods_tokens = token_output["prods_tokens"]
-        prods_mask = token_output["prods_mask"]
         prods_smiles = token_output["products_smiles"]
 
-        reacts_token_ids = self.tokeniser.convert_tokens_to_ids(reacts_tokens)
-        prods_token_ids = self.tokeniser.convert_tokens_to_ids(prods_tokens)
-
-        reacts_token_ids = torch.tensor(reacts_token_ids).transpose(0, 1)
-        reacts_pad_mask = torch.tensor(reacts_mask, dtype=torch.bool).transpose(0, 1)
-        prods_token_ids = torch.tensor(prods_token_ids).transpose(0, 1)
-        prods_pad_mask = torch.tensor(prods_mask, dtype=torch.bool).transpose(0, 1)
+        reacts_token_ids = torch.from_numpy(token_output["reacts_ids"])
+        reacts_pad_mask = torch.from_numpy(token_output["reacts_mask"])
+        prods_token_ids = torch.from_numpy(token_output["prods_ids"])
+        prods_pad_mask = torch.from_numpy(token_output["prods_mask"])
 
         collate_output = {
             "encoder_input": reacts_token_ids,
             "encoder_pad_mask": reacts_pad_mask,
             "decoder_input": prods_token_ids[:-1, :],
             "decoder_pad_mask": prods_pad_mask[:-1, :],
-            "target": prods_token_ids.clone()[1:, :],
-            "target_pad_mask": prods_pad_mask.clone()[1:, :],
+            "target": prods_token_ids[1:, :],
+            "target_pad_mask": prods_pad_mask[1:, :],
             "target_smiles": prods_smiles
         }
 
@@ -342,11 +396,13 @@ class FineTuneReactionDataModule(_AbsDataModule):
             train (bool): Whether generating data for training or not
 
         Output:
-            Dictionary output from tokeniser: {
-                "reacts_tokens" (List[List[str]]): Reactant tokens from tokeniser,
-                "prods_tokens" (List[List[str]]): Product tokens from tokeniser,
-                "reacts_masks" (List[List[int]]): 0 refers to not padded, 1 refers to padded,
-                "prods_masks" (List[List[int]]): 0 refers to not padded, 1 refers to padded
+            Dictionary of arrays of shape (seq_len, batch_size) and SMILES strings: {
+                "reacts_ids" (np.ndarray): Reactant token ids from tokeniser,
+                "prods_ids" (np.ndarray): Product token ids from tokeniser,
+                "reacts_mask" (np.ndarray): True where the reactant token is padding,
+                "prods_mask" (np.ndarray): True where the product token is padding,
+                "reactants_smiles" (List[str]): Reactant SMILES strings,
+                "products_smiles" (List[str]): Product SMILES strings
             }
         """
 
@@ -362,21 +418,21 @@ class FineTuneReactionDataModule(_AbsDataModule):
         else:
             prods = [Chem.MolToSmiles(prod) for prod in prods]
 
-        reacts_output = self.tokeniser.tokenise(reacts, pad=True)
-        prods_output = self.tokeniser.tokenise(prods, pad=True)
+        reacts_output = self.tokeniser.tokenise_ids(reacts, batch_first=False)
+        prods_output = self.tokeniser.tokenise_ids(prods, batch_first=False)
 
-        reacts_tokens = reacts_output["original_tokens"]
+        reacts_ids = reacts_output["original_ids"]
         reacts_mask = reacts_output["pad_masks"]
-        reacts_tokens, reacts_mask = self._check_seq_len(reacts_tokens, reacts_mask)
+        reacts_ids, reacts_mask = self._check_seq_len(reacts_ids, reacts_mask)
 
-        prods_tokens = prods_output["original_tokens"]
+        prods_ids = prods_output["original_ids"]
         prods_mask = prods_output["pad_masks"]
-        prods_tokens, prods_mask = self._check_seq_len(prods_tokens, prods_mask)
+        prods_ids, prods_mask = self._check_seq_len(prods_ids, prods_mask)
 
         token_output = {
-            "reacts_tokens": reacts_tokens,
+            "reacts_ids": reacts_ids,
             "reacts_mask": reacts_mask,
-            "prods_tokens": prods_tokens,
+            "prods_ids": prods_ids,
             "prods_mask": prods_mask,
             "reactants_smiles": reacts,
             "products_smiles": prods
@@ -408,27 +464,20 @@ class FineTuneMolOptDataModule(_AbsDataModule):
 
     def _collate(self, batch, train=True):
         token_output = self._prepare_tokens(batch, train)
-        reacts_tokens = token_output["reacts_tokens"]
-        reacts_mask = token_output["reacts_mask"]
-        prods_tokens = token_output["prods_tokens"]
-        prods_mask = token_output["prods_mask"]
         prods_smiles = token_output["products_smiles"]
 
-        reacts_token_ids = self.tokeniser.convert_tokens_to_ids(reacts_tokens)
-        prods_token_ids = self.tokeniser.convert_tokens_to_ids(prods_tokens)
-
-        reacts_token_ids = torch.tensor(reacts_token_ids).transpose(0, 1)
-        reacts_pad_mask = torch.tensor(reacts_mask, dtype=torch.bool).transpose(0, 1)
-        prods_token_ids = torch.tensor(prods_token_ids).transpose(0, 1)
-        prods_pad_mask = torch.tensor(prods_mask, dtype=torch.bool).transpose(0, 1)
+        reacts_token_ids = torch.from_numpy(token_output["reacts_ids"])
+        reacts_pad_mask = torch.from_numpy(token_output["reacts_mask"])
+        prods_token_ids = torch.from_numpy(token_output["prods_ids"])
+        prods_pad_mask = torch.from_numpy(token_output["prods_mask"])
 
         collate_output = {
             "encoder_input": reacts_token_ids,
             "encoder_pad_mask": reacts_pad_mask,
             "decoder_input": prods_token_ids[:-1, :],
             "decoder_pad_mask": prods_pad_mask[:-1, :],
-            "target": prods_token_ids.clone()[1:, :],
-            "target_pad_mask": prods_pad_mask.clone()[1:, :],
+            "target": prods_token_ids[1:, :],
+            "target_pad_mask": prods_pad_mask[1:, :],
             "target_smiles": prods_smiles
         }
 
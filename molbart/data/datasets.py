@@ -1,6 +1,7 @@
 import random
 import functools
 import torch
+import numpy as np
 import pandas as pd
 import pytorch_lightning as pl
 from pathlib import Path
@@ -189,34 +190,102 @@ class MoleculeDataset(_AbsDataset):
         super(MoleculeDataset, self).__init__()
 
         self.molecules = molecules
-        self.seq_lengths = seq_lengths
+        self.seq_lengths = np.asarray(seq_lengths, dtype=np.int32) if seq_lengths is not None else None
         self.transform = transform
         self.train_idxs = train_idxs
         self.val_idxs = val_idxs
         self.test_idxs = test_idxs
 
+        self.token_ids = None
+        self.token_offsets = None
+
     def __len__(self):
         return len(self.molecules)
 
     def __getitem__(self, item):
+        if self.token_ids is not None:
+            return np.asarray(self.token_ids[self.token_offsets[item]:self.token_offsets[item + 1]])
+
         molecule = self.molecules[item]
         if self.transform is not None:
             molecule = self.transform(molecule)
 
         return molecule
 
+    def precompute_ids(self, tokeniser, cache_dir=None, chunk_size=10000, num_threads=1):
+        """ Tokenise the canonical SMILES of every molecule once and store the token ids
+
+        Once the ids have been computed __getitem__ returns the token ids for the molecule
+        (including begin and end tokens, without padding) instead of the molecule itself.
+        This is only useful when the molecules are not augmented, since the ids are fixed.
+
+        The ids of every molecule are stored back to back in one flat array, in the smallest integer type
+        which holds the vocab, with the offset of each molecule's ids in a second array.
+
+        If cache_dir is given the ids are saved there as ids.npy and offsets.npy, or loaded from
+        there if the files already exist. Cached arrays are memory-mapped rather than read into memory.
+        The cache is not checked against the tokeniser, so it must be removed when the vocab changes.
+
+        Args:
+            tokeniser (MolEncTokeniser): Tokeniser to use
+            cache_dir (Optional[str]): Directory to save or load the token ids
+            chunk_size (int): Number of molecules to tokenise at a time
+            num_threads (int): Maximum number of threads used to split each chunk into tokens
+        """
+
+        if cache_dir is not None:
+            ids_path = Path(cache_dir) / "ids.npy"
+            offsets_path = Path(cache_dir) / "offsets.npy"
+            if ids_path.exists() and offsets_path.exists():
+                self.token_ids = np.load(ids_path, mmap_mode="r")
+                self.token_offsets = np.load(offsets_path, mmap_mode="r")
+                return
+
+        id_dtype = np.int16 if len(tokeniser) <= np.iinfo(np.int16).max else np.int32
+
+        chunk_ids = []
+        lengths = []
+        for start in range(0, len(self), chunk_size):
+            mols = [self[idx] for idx in range(start, min(start + chunk_size, len(self)))]
+            smiles = [Chem.MolToSmiles(mol, canonical=True) for mol in mols]
+            ids, pad_mask = tokeniser.tokenise_to_ids(smiles, num_threads=num_threads)
+
+            # Rows are batch first, so the unpadded ids are read out in molecule order
+            chunk_ids.append(ids[~pad_mask].astype(id_dtype))
+            lengths.append((~pad_mask).sum(axis=1))
+
+        token_ids = np.concatenate(chunk_ids) if len(chunk_ids) > 0 else np.empty(0, dtype=id_dtype)
+        token_offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        if len(lengths) > 0:
+            np.cumsum(np.concatenate(lengths), out=token_offsets[1:])
+
+        if cache_dir is not None:
+            Path(cache_dir).mkdir(parents=True, exist_ok=True)
+            np.save(ids_path, token_ids)
+            np.save(offsets_path, token_offsets)
+            token_ids = np.load(ids_path, mmap_mode="r")
+            token_offsets = np.load(offsets_path, mmap_mode="r")
+
+        self.token_ids = token_ids
+        self.token_offsets = token_offsets
+
     def split_idxs(self, val_idxs, test_idxs):
+        val_idxs = np.asarray(val_idxs, dtype=np.int64)
         val_mols = [self.molecules[idx] for idx in val_idxs]
-        val_lengths = [self.seq_lengths[idx] for idx in val_idxs] if self.seq_lengths is not None else None
+        val_lengths = self.seq_lengths[val_idxs] if self.seq_lengths is not None else None
         val_dataset = MoleculeDataset(val_mols, val_lengths, self.transform)
 
+        test_idxs = np.asarray(test_idxs, dtype=np.int64)
         test_mols = [self.molecules[idx] for idx in test_idxs]
-        test_lengths = [self.seq_lengths[idx] for idx in test_idxs] if self.seq_lengths is not None else None
+        test_lengths = self.seq_lengths[test_idxs] if self.seq_lengths is not None else None
         test_dataset = MoleculeDataset(test_mols, test_lengths, self.transform)
 
-        train_idxs = set(range(len(self))) - set(val_idxs).union(set(test_idxs))
-        train_mols = [self.molecules[idx] for idx in sorted(train_idxs)]
-        train_lengths = [self.seq_lengths[idx] for idx in train_idxs] if self.seq_lengths is not None else None
+        train_mask = np.ones(len(self), dtype=bool)
+        train_mask[val_idxs] = False
+        train_mask[test_idxs] = False
+        train_idxs = np.flatnonzero(train_mask)
+        train_mols = [self.molecules[idx] for idx in train_idxs]
+        train_lengths = self.seq_lengths[train_idxs] if self.seq_lengths is not None else None
         train_dataset = MoleculeDataset(train_mols, train_lengths, self.transform)
 
         return train_dataset, val_dataset, test_dataset
@@ -228,7 +297,7 @@ class Chembl(MoleculeDataset):
         df = pd.read_pickle(path)
 
         molecules = df["molecules"].tolist()
-        lengths = df["lengths"].tolist()
+        lengths = df["lengths"].values
         train_idxs, val_idxs, test_idxs = self._save_idxs(df)
 
         super().__init__(
@@ -1,5 +1,109 @@
-import random
-from torch.utils.data import Sampler, RandomSampler, SequentialSampler
+import os
+import queue
+import threading
+import torch
+import multiprocessing
+import numpy as np
+from rdkit import Chem
+from torch.utils.data import Sampler
+
+
+DEFAULT_MAX_DATA_WORKERS = 8
+
+
+def default_num_workers():
+    """ Number of DataLoader worker processes to use for each device
+
+    Can be set with the NUM_DATA_WORKERS environment variable, otherwise the CPUs are shared
+    between the visible GPUs with at most DEFAULT_MAX_DATA_WORKERS workers per GPU.
+    """
+
+    num_workers = os.environ.get("NUM_DATA_WORKERS")
+    if num_workers is not None:
+        return int(num_workers)
+
+    num_devices = max(1, torch.cuda.device_count())
+    cpus_per_device = max(1, multiprocessing.cpu_count() // num_devices)
+    return min(DEFAULT_MAX_DATA_WORKERS, cpus_per_device)
+
+
+def worker_init_fn(worker_id):
+    """ Initialise a DataLoader worker process
+
+    Each worker already runs in parallel with the others, so intra-op threading
+    in the worker would only oversubscribe the CPUs.
+
+    The tokeniser draws its masks from NumPy's global RNG, which forked workers would otherwise
+    all inherit in the same state, so it is reseeded from the worker's torch seed.
+    """
+
+    torch.set_num_threads(1)
+    np.random.seed(torch.initial_seed() % (2 ** 32))
+
+
+def mol_to_smiles(mol, orig_mol, canonical=False):
+    """ Generate the SMILES string for a (possibly augmented) molecule
+
+    There is a very rare possibility that RDKit will not be able to generate the SMILES for the augmented mol
+    In this case we just use the canonical SMILES of the original mol
+
+    Args:
+        mol (Chem.Mol): Molecule to write out
+        orig_mol (Chem.Mol): Original molecule, used if the SMILES for mol cannot be generated
+        canonical (bool): Whether to generate canonical SMILES for mol
+
+    Returns:
+        smi (str): SMILES string
+    """
+
+    try:
+        smi = Chem.MolToSmiles(mol, canonical=canonical)
+    except RuntimeError:
+        smi = Chem.MolToSmiles(orig_mol, canonical=True)
+        print(f"Could not generate smiles after augmenting: {smi}")
+
+    return smi
+
+
+def _length_buckets(num_buckets, seq_lengths, batch_size):
+    """ Split sequences into buckets of similar length and size the batches for each bucket
+
+    Buckets have equal width in sequence length, so some may be empty. The number of sequences in
+    each batch from a bucket is chosen so the batch holds approximately batch_size tokens.
+
+    Args:
+        num_buckets (int): Number of buckets to split sequences into
+        seq_lengths (np.ndarray): The length of the sequences in the dataset (in the same order)
+        batch_size (int): Target number of tokens in each batch
+
+    Returns:
+        buckets (List[np.ndarray]): Dataset indices in each bucket, in dataset order
+        num_seqs (List[int]): Number of sequences in each batch from the bucket,
+                              0 if the bucket is empty or its sequences are longer than batch_size
+    """
+
+    seq_lengths = np.asarray(seq_lengths)
+    min_length = seq_lengths.min()
+    max_length = seq_lengths.max() + 1
+    bucket_width = (max_length - min_length) / num_buckets
+
+    # Setup upper (exclusive) seq length limits on buckets, the lower limit of each bucket is
+    # the upper limit of the one before
+    upper_limits = []
+    upper_limit = float(min_length)
+    for _ in range(num_buckets):
+        upper_limit = upper_limit + bucket_width
+        upper_limits.append(upper_limit)
+
+    # Add indices to correct bucket based on seq length, done once rather than every epoch
+    bucket_ids = np.digitize(seq_lengths, upper_limits)
+    buckets = [np.flatnonzero(bucket_ids == b_idx) for b_idx in range(num_buckets)]
+
+    # Work out approx number of sequences required for each bucket
+    avg_lengths = [seq_lengths[idxs].sum() // len(idxs) if len(idxs) > 0 else 0 for idxs in buckets]
+    num_seqs = [int(batch_size // length) if length > 0 else 0 for length in avg_lengths]
+
+    return buckets, num_seqs
 
 
 class TokenSampler(Sampler):
@@ -28,7 +132,7 @@ class TokenSampler(Sampler):
 
         Args:
             num_buckets (int): Number of buckets to split sequences into
-            seq_lengths (List[int]): The length of the sequences in the dataset (in the same order)
+            seq_lengths (np.ndarray): The length of the sequences in the dataset (in the same order)
             batch_size (int): Target number of tokens in each batch
             shuffle (Optional[bool]): Shuffle the indices within each bucket
             drop_last (Optional[bool]): Forget about the indices remaining at the end of each bucket
@@ -37,56 +141,215 @@ class TokenSampler(Sampler):
         if not drop_last:
             raise NotImplementedError("Keeping last elements is not yet supported")
 
-        min_length = min(seq_lengths)
-        max_length = max(seq_lengths) + 1
-        bucket_width = (max_length - min_length) / num_buckets
+        buckets, num_seqs = _length_buckets(num_buckets, seq_lengths, batch_size)
+        num_batches = [len(bucket) // num_seqs[b_idx] if num_seqs[b_idx] > 0 else 0
+                       for b_idx, bucket in enumerate(buckets)]
 
-        bucket_limits = []
-        lower_limit = float(min_length)
+        self.num_seqs = num_seqs
+        self.buckets = buckets
+        self.num_batches = num_batches
+        self.shuffle = shuffle
 
-        # Setup lower (inclusive) and upper (exclusive) seq length limits on buckets
-        for _ in range(num_buckets):
-            upper_limit = lower_limit + bucket_width
-            bucket_limits.append((lower_limit, upper_limit))
-            lower_limit = upper_limit
+    def __iter__(self):
+        # Drawing buckets in proportion to their remaining batches is the same as
+        # shuffling the bucket ids of all batches
+        bucket_ids = np.repeat(np.arange(len(self.buckets)), self.num_batches)
+        bucket_order = np.random.permutation(bucket_ids)
+        bucket_idxs = self.buckets
+        if self.shuffle:
+            bucket_idxs = [np.random.permutation(idxs) for idxs in bucket_idxs]
 
-        buckets = [[] for _ in range(num_buckets)]
-        lengths = [[] for _ in range(num_buckets)]
+        starts = [0] * len(self.buckets)
+        for b_idx in bucket_order:
+            start = starts[b_idx]
+            end = start + self.num_seqs[b_idx]
+            starts[b_idx] = end
+            yield bucket_idxs[b_idx][start:end].tolist()
 
-        # Add indices to correct bucket based on seq length
-        for seq_idx, length in enumerate(seq_lengths):
-            for b_idx, (lower, upper) in enumerate(bucket_limits):
-                if lower <= length < upper:
-                    buckets[b_idx].append(seq_idx)
-                    lengths[b_idx].append(length)
+    def __len__(self):
+        return sum(self.num_batches)
 
-        if shuffle:
-            samplers = [RandomSampler(idxs) for idxs in buckets]
-        else:
-            samplers = [SequentialSampler(idxs) for idxs in buckets]
 
-        # Work out approx number of sequences required for each bucket
-        avg_lengths = [sum(ls) // len(ls) for ls in lengths]
-        num_seqs = [batch_size // length for length in avg_lengths]
-        num_seqs = [int(num_sq) for num_sq in num_seqs]
+class DistTokenSampler(Sampler):
+    """
+    Distributed batch sampler which groups sequences of similar length.
 
-        num_batches = [len(bucket) // num_seqs[b_idx] for b_idx, bucket in enumerate(buckets)]
-        num_batches = [int(num_bs) for num_bs in num_batches]
+    Sequences are split into buckets and batches are sized in the same way as TokenSampler.
+    Every rank builds the same list of batches for an epoch, from a seed shared by all ranks,
+    and then takes every world_size'th batch, so each rank sees the same number of batches
+    and no sequence is seen by more than one rank.
+    """
+
+    def __init__(
+        self,
+        num_buckets,
+        seq_lengths,
+        batch_size,
+        rank,
+        world_size,
+        shuffle=True,
+        seed=None
+    ):
+        """ Init method
+
+        Args:
+            num_buckets (int): Number of buckets to split sequences into
+            seq_lengths (np.ndarray): The length of the sequences in the dataset (in the same order)
+            batch_size (int): Target number of tokens in each batch
+            rank (int): Data parallel rank of this process
+            world_size (int): Number of data parallel processes
+            shuffle (Optional[bool]): Shuffle the sequences in each bucket and the order of batches
+            seed (Optional[int]): Shuffle seed, broadcast from rank 0 if not given
+        """
+
+        buckets, num_seqs = _length_buckets(num_buckets, seq_lengths, batch_size)
+        num_batches = sum(len(idxs) // n for idxs, n in zip(buckets, num_seqs) if n > 0)
+
+        if seed is None:
+            seed = self._broadcast_seed()
 
-        self.num_seqs = num_seqs
         self.buckets = buckets
-        self.num_batches = num_batches
-        self.samplers = samplers
+        self.num_seqs = num_seqs
+        self.num_batches = num_batches // world_size
+        self.rank = rank
+        self.world_size = world_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    @staticmethod
+    def _broadcast_seed():
+        seed = torch.cuda.LongTensor([np.random.randint(2 ** 31)])
+        torch.distributed.broadcast(seed, 0)
+        return int(seed.item())
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
 
     def __iter__(self):
-        iters = [iter(sampler) for sampler in self.samplers]
-        rem_batches = self.num_batches[:]
-        while sum(rem_batches) > 0:
-            b_idx = random.choices(range(len(rem_batches)), weights=rem_batches, k=1)[0]
-            batch_idxs = [next(iters[b_idx]) for _ in range(self.num_seqs[b_idx])]
-            batch = [self.buckets[b_idx][idx] for idx in batch_idxs]
-            rem_batches[b_idx] -= 1
-            yield batch
+        rng = np.random.RandomState(self.seed + self.epoch)
+
+        batches = []
+        for idxs, num_seqs in zip(self.buckets, self.num_seqs):
+            num_batches = len(idxs) // num_seqs if num_seqs > 0 else 0
+            if num_batches == 0:
+                continue
+
+            if self.shuffle:
+                idxs = rng.permutation(idxs)
+            batches.extend(np.split(idxs[:num_batches * num_seqs], num_batches))
+
+        if self.shuffle:
+            batches = [batches[b_idx] for b_idx in rng.permutation(len(batches))]
+
+        num_batches = self.num_batches * self.world_size
+        for batch in batches[self.rank:num_batches:self.world_size]:
+            yield batch.tolist()
 
     def __len__(self):
-        return sum(self.num_batches)
+        return self.num_batches
+
+
+class PrefetchLoader:
+    """
+    Wraps a DataLoader and fetches batches from it on a background thread, so the next batch
+    is collated and pinned while the current training step runs.
+
+    Only the work done in the main process (fetching from the worker queues and pinning) is
+    moved onto the thread, the batches are still built by the DataLoader's workers.
+    Errors raised while loading are re-raised from the iterator. If iteration stops early
+    the thread is stopped before the iterator is closed.
+    """
+
+    _SENTINEL = object()
+
+    # Seconds between checks for the consumer stopping while the producer waits on a full queue
+    _PUT_TIMEOUT = 0.1
+
+    def __init__(self, loader, prefetch=2, pin_memory=False):
+        """
+        Args:
+            loader (Iterable): Loader to wrap, usually a torch DataLoader
+            prefetch (int): Maximum number of batches to load ahead
+            pin_memory (bool): Pin tensors in batches which are not already pinned
+        """
+
+        self.loader = loader
+        self.prefetch = prefetch
+        self.pin_memory = pin_memory
+        self._thread = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        # The loader's iterator (and its pin memory thread) is created on the calling thread,
+        # which has the rank's CUDA device set, rather than on the producer thread which
+        # defaults to device 0
+        iterator = iter(self.loader)
+        device = torch.cuda.current_device() if torch.cuda.is_available() else None
+
+        q = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        args = (iterator, q, stop, device)
+        thread = threading.Thread(target=self._producer, args=args, daemon=True)
+        self._thread = thread
+        thread.start()
+
+        try:
+            while True:
+                item = q.get()
+                if item is self._SENTINEL:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+
+        # If iteration stops early the producer is stopped and waited for, so it cannot be left
+        # blocked on the full queue or still reading from the loader's iterator in the next epoch
+        finally:
+            stop.set()
+            while thread.is_alive():
+                self._drain(q)
+                thread.join(timeout=self._PUT_TIMEOUT)
+
+    def _producer(self, iterator, q, stop, device):
+        try:
+            if device is not None:
+                torch.cuda.set_device(device)
+
+            for batch in iterator:
+                if self.pin_memory:
+                    batch = self._pin(batch)
+                if not self._put(q, batch, stop):
+                    return
+        except Exception as e:
+            self._put(q, e, stop)
+            return
+
+        self._put(q, self._SENTINEL, stop)
+
+    def _put(self, q, item, stop):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=self._PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    @staticmethod
+    def _drain(q):
+        while True:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                return
+
+    def _pin(self, batch):
+        if isinstance(batch, dict):
+            return {key: self._pin(val) for key, val in batch.items()}
+        if torch.is_tensor(batch) and not batch.is_pinned():
+            return batch.pin_memory()
+        return batch
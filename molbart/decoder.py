@@ -57,10 +57,10 @@ class DecodeSampler:
         """
 
         # Create tensors which will be reused
-        token_ids = [self.begin_token_id] + ([self.pad_token_id] * (self.max_seq_len - 1))
-        token_ids = [token_ids] * batch_size
-        token_ids = torch.tensor(token_ids, device=self.device).transpose(0, 1)
-        pad_mask = torch.zeros((self.max_seq_len, batch_size), device=self.device, dtype=torch.bool)
+        size = (self.max_seq_len, batch_size)
+        token_ids = torch.full(size, self.pad_token_id, device=self.device, dtype=torch.int64)
+        token_ids[0, :] = self.begin_token_id
+        pad_mask = torch.zeros(size, device=self.device, dtype=torch.bool)
         log_lhs = torch.zeros((batch_size))
 
         # Iteratively apply the tokens to the model and build up the sequence
@@ -118,10 +118,10 @@ class DecodeSampler:
         """
 
         # Create tensors which will be reused
-        token_ids = [self.begin_token_id] + ([self.pad_token_id] * (self.max_seq_len - 1))
-        token_ids = [token_ids] * batch_size
-        token_ids = torch.tensor(token_ids, device=self.device).transpose(0, 1)
-        pad_mask = torch.zeros((self.max_seq_len, batch_size), device=self.device, dtype=torch.bool)
+        size = (self.max_seq_len, batch_size)
+        token_ids = torch.full(size, self.pad_token_id, device=self.device, dtype=torch.int64)
+        token_ids[0, :] = self.begin_token_id
+        pad_mask = torch.zeros(size, device=self.device, dtype=torch.bool)
 
         ts = token_ids[:1, :]
         ms = pad_mask[:1, :]
@@ -77,6 +77,10 @@ def load_model(args, sampler, vocab_size, total_steps, pad_token_idx):
 def main(args):
     print("Building tokeniser...")
     tokeniser = util.load_tokeniser(args.vocab_path, args.chem_token_start_idx)
+
+    # Without augmentation the same reactions are tokenised every epoch, caching only helps
+    # when they are split with the regex rather than the compiled scanner
+    tokeniser.cache_tokens = args.augment is None and not tokeniser.has_scanner
     print("Finished tokeniser.")
 
     print("Reading dataset...")
@@ -1,6 +1,56 @@
 import re
-import random
+import sys
+import numpy as np
+from functools import lru_cache
+from itertools import chain
 from pathlib import Path
+from types import MappingProxyType
+
+from molbart import _tokscan
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def _pad_flat_ids_np(flat_ids, lengths, pad_id, batch_first):
+    seq_len = lengths.max()
+    shape = (len(lengths), seq_len) if batch_first else (seq_len, len(lengths))
+    ids = np.full(shape, pad_id, dtype=np.int64)
+
+    # Sequences are stored back to back, which is the row-major order of the unpadded positions
+    # in the (batch_size, seq_len) layout, so seq first output is written through its transpose
+    rows = ids if batch_first else ids.T
+    rows[np.arange(seq_len) < lengths[:, None]] = flat_ids
+    return ids
+
+
+def _pad_flat_ids_loop(flat_ids, lengths, pad_id, batch_first):
+    seq_len = lengths.max()
+    shape = (len(lengths), seq_len) if batch_first else (seq_len, len(lengths))
+    ids = np.full(shape, pad_id, dtype=np.int64)
+
+    start = 0
+    for idx in range(len(lengths)):
+        end = start + lengths[idx]
+        if batch_first:
+            ids[idx, :lengths[idx]] = flat_ids[start:end]
+        else:
+            ids[:lengths[idx], idx] = flat_ids[start:end]
+        start = end
+
+    return ids
+
+
+# Numba compiles the plain loop to machine code and releases the GIL while it runs
+_pad_flat_ids = _pad_flat_ids_np if njit is None else njit(nogil=True, cache=True)(_pad_flat_ids_loop)
+
+
+# Keyed on the compiled regex as well as the string so tokenisers with different regexes can share the cache
+@lru_cache(maxsize=2 ** 16)
+def _cached_findall(prog, smiles):
+    return tuple(prog.findall(smiles))
 
 
 class MolEncTokeniser:
@@ -16,7 +66,9 @@ class MolEncTokeniser:
         mask_token="<MASK>",
         sep_token="<SEP>",
         mask_prob=0.15,
-        show_mask_token_prob=0.8
+        show_mask_token_prob=0.8,
+        extra_tokens=None,
+        cache_tokens=False
     ):
         """ Initialise the tokeniser
 
@@ -32,26 +84,93 @@ class MolEncTokeniser:
             sep_token (str): Token to use when sepatating two sentences
             mask_prob (float): Probability of token being masked when masking is enabled
             show_mask_token_prob (float): Probability of a masked token being replaced with mask token
+            extra_tokens (Optional[List[str]]): Extra tokens compiled into prog, needed to tokenise to ids
+                                                without the regex
+            cache_tokens (bool): Whether to cache the regex matches of each SMILES string, only worthwhile
+                                 when the same strings are tokenised repeatedly (eg. without augmentation).
+                                 tokenise_ids does not use the cache when has_scanner is True, since the
+                                 compiled scanner does not use the regex
         """
 
-        self.vocab = {t: i for i, t in enumerate(vocab)}
-        self.decode_vocab = {i: t for t, i in self.vocab.items()}
+        # Vocab strings are interned so that tokens produced from the vocab
+        # (decoding, masking) share objects with the special token attributes
+        self._set_vocab({t: i for i, t in enumerate(vocab)})
         self.chem_token_idxs = chem_token_idxs
+        self._chem_token_idx_array = np.array(chem_token_idxs, dtype=np.int64)
         self.prog = prog
 
-        self.begin_token = begin_token
-        self.end_token = end_token
-        self.pad_token = pad_token
-        self.unk_token = unk_token
-        self.mask_token = mask_token
-        self.sep_token = sep_token
+        self.begin_token = sys.intern(begin_token)
+        self.end_token = sys.intern(end_token)
+        self.pad_token = sys.intern(pad_token)
+        self.unk_token = sys.intern(unk_token)
+        self.mask_token = sys.intern(mask_token)
+        self.sep_token = sys.intern(sep_token)
 
         self.mask_prob = mask_prob
         self.show_mask_token_prob = show_mask_token_prob
+        self.cache_tokens = cache_tokens
 
+        self.begin_id = self.vocab[begin_token]
+        self.end_id = self.vocab[end_token]
+        self.pad_id = self.vocab[pad_token]
         self.unk_id = self.vocab[unk_token]
+        self.mask_id = self.vocab[mask_token]
+        self.sep_id = self.vocab[sep_token]
         self.unk_token_cnt = {}
 
+        # SMILES are split with a compiled scanner instead of the regex when prog is the one it reproduces
+        self._scan_tables = None
+        if extra_tokens is not None:
+            scan_regexes = [_tokscan.REGEX, _tokscan.LEGACY_REGEX]
+            scan_patterns = [self._get_compiled_regex(regex, extra_tokens).pattern for regex in scan_regexes]
+            if prog.pattern in scan_patterns:
+                self._scan_tables = _tokscan.build_scan_tables(self.vocab, extra_tokens)
+
+        # Built by tokenise_cudf on first use
+        self._cudf_vocab = None
+
+    def __getstate__(self):
+        # The GPU vocabulary is not pickled, each process builds its own
+        state = self.__dict__.copy()
+        state["_cudf_vocab"] = None
+        del state["vocab"]
+        del state["decode_vocab"]
+        del state["_decode_vocab"]
+        return state
+
+    def __setstate__(self, state):
+        # Tokenisers pickled before the vocab views were added store the plain dicts as vocab and decode_vocab
+        vocab = state.get("_vocab", state.get("vocab"))
+        self.__dict__.update({key: val for key, val in state.items() if key not in ["vocab", "decode_vocab"]})
+        self._set_vocab(vocab)
+
+        # Unpickled strings are not interned
+        for attr in ["begin_token", "end_token", "pad_token", "unk_token", "mask_token", "sep_token"]:
+            setattr(self, attr, sys.intern(getattr(self, attr)))
+
+        # Derived attributes are rebuilt, older pickles do not have them.
+        # Their extra tokens are not known, so they tokenise with the regex rather than the scanner
+        for attr in ["begin", "end", "pad", "unk", "mask", "sep"]:
+            setattr(self, f"{attr}_id", self._vocab[getattr(self, f"{attr}_token")])
+
+        self._chem_token_idx_array = np.array(self.chem_token_idxs, dtype=np.int64)
+        self.__dict__.setdefault("cache_tokens", False)
+        self.__dict__.setdefault("_scan_tables", None)
+        self.__dict__.setdefault("_cudf_vocab", None)
+
+    @property
+    def has_scanner(self):
+        """ Whether tokenise_ids splits SMILES with the compiled scanner rather than the regex """
+        return self._scan_tables is not None
+
+    def _set_vocab(self, vocab):
+        # The vocab is fixed once the tokeniser is built, so it is only exposed through read-only views.
+        # Lookups through a proxy are slower than on the dict, so the hot loops use the private dicts
+        self._vocab = {sys.intern(t): i for t, i in vocab.items()}
+        self._decode_vocab = {i: t for t, i in self._vocab.items()}
+        self.vocab = MappingProxyType(self._vocab)
+        self.decode_vocab = MappingProxyType(self._decode_vocab)
+
     @staticmethod
     def from_vocab_file(
         vocab_path,
@@ -64,7 +183,8 @@ class MolEncTokeniser:
         mask_token_idx=4,
         sep_token_idx=5,
         mask_prob=0.15,
-        show_mask_token_prob=0.8
+        show_mask_token_prob=0.8,
+        cache_tokens=False
     ):
         """ Load the tokeniser object from a vocab file and regex
 
@@ -77,6 +197,7 @@ class MolEncTokeniser:
             vocab_path (str): Path to vocab file
             regex (str): Regex to use for tokenising
             chem_tokens_start_idx (int): Index of the start of the chemical tokens in the tokens list
+            cache_tokens (bool): Whether to cache the regex matches of each SMILES string
 
         Returns:
             MolEncTokeniser object
@@ -110,7 +231,9 @@ class MolEncTokeniser:
             mask_token=mask_token,
             sep_token=sep_token,
             mask_prob=mask_prob,
-            show_mask_token_prob=show_mask_token_prob
+            show_mask_token_prob=show_mask_token_prob,
+            extra_tokens=extra_tokens,
+            cache_tokens=cache_tokens
         )
         return tokeniser
 
@@ -126,7 +249,8 @@ class MolEncTokeniser:
         mask_token="<MASK>",
         sep_token="<SEP>",
         mask_prob=0.15,
-        show_mask_token_prob=0.8
+        show_mask_token_prob=0.8,
+        cache_tokens=False
     ):
         """ Build the tokeniser from smiles strings and a regex
 
@@ -135,6 +259,7 @@ class MolEncTokeniser:
             regex (str): Regex to use for tokenising
             extra_tokens (Optional[List[str]]): Additional tokens to add to the vocabulary that 
                                                 may not appear in the SMILES strings
+            cache_tokens (bool): Whether to cache the regex matches of each SMILES string
         """
 
         vocab = {
@@ -153,9 +278,10 @@ class MolEncTokeniser:
         prog = MolEncTokeniser._get_compiled_regex(regex, extra_tokens)
         print(f"Chemistry tokens start at index {chem_start_idx}")
 
-        for smi in smiles:
-            for token in prog.findall(smi):
-                vocab.setdefault(token, len(vocab))
+        # Chemical tokens are numbered in the order they are first seen
+        smiles_tokens = dict.fromkeys(chain.from_iterable(map(prog.findall, smiles)))
+        for token in smiles_tokens:
+            vocab.setdefault(token, len(vocab))
 
         chem_token_idxs = list(range(chem_start_idx, len(vocab)))
 
@@ -173,7 +299,9 @@ class MolEncTokeniser:
             mask_token=mask_token,
             sep_token=sep_token,
             mask_prob=mask_prob,
-            show_mask_token_prob=show_mask_token_prob
+            show_mask_token_prob=show_mask_token_prob,
+            extra_tokens=extra_tokens,
+            cache_tokens=cache_tokens
         )
         return tokeniser
 
@@ -195,6 +323,9 @@ class MolEncTokeniser:
         if sents2 is not None and len(sents1) != len(sents2):
             raise ValueError("Sentence 1 batch and sentence 2 batch must have the same number of elements")
 
+        if sents2 is None:
+            return self._tokenise_sentences(sents1, mask, pad)
+
         tokens = self._regex_match(sents1)
         m_tokens, token_masks = self._mask_tokens(tokens, empty_mask=not mask)
 
@@ -232,22 +363,89 @@ class MolEncTokeniser:
 
         return output
 
+    def _tokenise_sentences(self, sents, mask, pad):
+        """ Tokenise a batch of single sentences
+
+        Produces the same output as the general path through tokenise (including the order of random draws
+        when masking), but each row is wrapped in begin and end tokens and padded as it is built
+        rather than in separate passes over the whole batch.
+        """
+
+        tokens = self._regex_match(sents)
+        lengths = [len(ts) + 2 for ts in tokens]
+        pad_length = max(lengths) if pad else 0
+
+        begin_token = self.begin_token
+        end_token = self.end_token
+        pads = [self.pad_token] * pad_length
+        no_masks = [False] * pad_length
+        pad_mask_row = ([0] * pad_length) + ([1] * pad_length)
+
+        if mask:
+            m_tokens, m_token_masks = self._mask_tokens(tokens)
+
+        orig_tokens = []
+        masked_tokens = []
+        token_masks = []
+        pad_masks = []
+        for row, (ts, length) in enumerate(zip(tokens, lengths)):
+            orig = [begin_token]
+            orig.extend(ts)
+            orig.append(end_token)
+            orig.extend(pads[length:])
+            orig_tokens.append(orig)
+
+            if mask:
+                masked = [begin_token]
+                masked.extend(m_tokens[row])
+                masked.append(end_token)
+                masked.extend(pads[length:])
+                masked_tokens.append(masked)
+
+                token_mask = [False]
+                token_mask.extend(m_token_masks[row])
+                token_mask.append(False)
+                token_mask.extend(no_masks[length:])
+                token_masks.append(token_mask)
+
+            if pad:
+                pad_masks.append(pad_mask_row[pad_length - length:(2 * pad_length) - length])
+
+        output = {}
+        if pad:
+            output["pad_masks"] = pad_masks
+
+        output["original_tokens"] = orig_tokens
+
+        if mask:
+            output["masked_tokens"] = masked_tokens
+            output["token_masks"] = token_masks
+
+        return output
+
     def _regex_match(self, smiles):
-        tokenised = []
-        for smi in smiles:
-            tokens = self.prog.findall(smi)
-            tokenised.append(tokens)
+        if self.cache_tokens:
+            prog = self.prog
+            return [list(_cached_findall(prog, smi)) for smi in smiles]
 
-        return tokenised
+        findall = self.prog.findall
+        return [findall(smi) for smi in smiles]
 
     @staticmethod
     def _get_compiled_regex(regex, extra_tokens):
-        regex_string = r"("
+        # Extra tokens are grouped by their first character behind a lookahead, so at each position
+        # re checks one character per group instead of trying every extra token in turn.
+        # Tokens keep their order within a group, and tokens in different groups cannot match at the same position
+        token_groups = {}
         for token in extra_tokens:
             processed_token = token
             for special_character in "()[].|":
                 processed_token = processed_token.replace(special_character, f"\\{special_character}")
-            regex_string += processed_token + r"|"
+            token_groups.setdefault(token[:1], []).append(processed_token)
+
+        regex_string = r"("
+        for first_char, tokens in token_groups.items():
+            regex_string += f"(?={re.escape(first_char)})(?:" + r"|".join(tokens) + r")|"
 
         regex_string += regex + r"|"
         regex_string += r".)"
@@ -275,27 +473,282 @@ class MolEncTokeniser:
         return strs
 
     def convert_tokens_to_ids(self, token_data):
-        ids_list = []
-        for tokens in token_data:
+        lookup_ids = self._lookup_ids
+        return [lookup_ids(tokens) for tokens in token_data]
+
+    def convert_tokens_to_id_array(self, token_data, batch_first=True):
+        """ Convert a batch of token sequences into a padded array of token ids
+
+        Each row is written straight into a pre-allocated array so no intermediate lists of ids are built.
+        Rows shorter than the longest sequence are filled with the pad token id.
+        With batch_first=False the ids are written in (seq_len, batch_size) order directly, so no transpose
+        is needed for models which take the sequence dimension first.
+
+        Args:
+            token_data (List[List[str]]): Batch of token sequences
+            batch_first (bool): Whether the batch is the first dimension of the output arrays
+
+        Returns:
+            ids (np.ndarray): Token ids, shape (batch_size, seq_len) or (seq_len, batch_size), dtype int64
+            pad_mask (np.ndarray): True where the token is padding, same shape as ids
+        """
+
+        # Every token in the batch is looked up in one pass, then the rows are padded together
+        lengths = np.fromiter(map(len, token_data), dtype=np.int64, count=len(token_data))
+        flat_ids = np.array(self._lookup_ids(list(chain.from_iterable(token_data))), dtype=np.int64)
+        ids = _pad_flat_ids(flat_ids, lengths, self.pad_id, batch_first)
+
+        pad_mask = ids == self.pad_id
+        return ids, pad_mask
+
+    def tokenise_to_ids(self, smiles, batch_first=True, num_threads=1):
+        """ Tokenise a batch of SMILES strings straight into a padded array of token ids
+
+        Equivalent to tokenise(smiles, pad=True) followed by convert_tokens_to_id_array,
+        but the regex matches are mapped to ids as they are produced, so no begin, end or pad
+        token lists are built. No masking is applied.
+
+        Args:
+            smiles (List[str]): Batch of SMILES strings
+            batch_first (bool): Whether the batch is the first dimension of the output arrays
+            num_threads (int): Maximum number of threads used to split large batches into tokens,
+                               only used when the tokeniser has a compiled scanner
+
+        Returns:
+            ids (np.ndarray): Token ids, shape (batch_size, seq_len) or (seq_len, batch_size), dtype int64
+            pad_mask (np.ndarray): True where the token is padding, same shape as ids
+        """
+
+        output = self.tokenise_ids(smiles, batch_first=batch_first, num_threads=num_threads)
+        return output["original_ids"], output["pad_masks"]
+
+    def tokenise_cudf(self, smiles, batch_first=True):
+        """ Tokenise a column of SMILES strings into padded token ids on the GPU
+
+        Requires cudf. The regex split and the vocab lookup both run on the GPU, only the flat ids and the
+        number of tokens in each row are copied back to be padded. Unknown tokens are given the id of the
+        unknown token but are not counted in unk_token_cnt.
+
+        Args:
+            smiles (Union[List[str], cudf.Series]): SMILES strings
+            batch_first (bool): Whether the batch is the first dimension of the output arrays
+
+        Returns:
+            ids (np.ndarray): Token ids, shape (batch_size, seq_len) or (seq_len, batch_size), dtype int64
+            pad_masks (np.ndarray): True where the token is padding, same shape as ids
+        """
+
+        import cudf
+        from cudf.core.tokenize_vocabulary import TokenizeVocabulary
+
+        if self._cudf_vocab is None:
+            self._cudf_vocab = TokenizeVocabulary(cudf.Series(list(self.vocab)))
+
+        if not isinstance(smiles, cudf.Series):
+            smiles = cudf.Series(smiles)
+
+        # libcudf regexes have no lookahead, without the first character lookaheads the extra token groups
+        # are a plain alternation which matches the same tokens
+        pattern = re.sub(r"\(\?=(?:\\.|[^\\])\)", "", self.prog.pattern)
+
+        # Tokens may contain spaces so are joined with a control character which cannot be in a vocab token.
+        # Only rows with tokens are given a leading delimiter, so an empty string does not give an empty token
+        delimiter = "\x1f"
+        sents = smiles.str.findall(pattern).str.join(delimiter)
+        sents = sents.str.insert(0, delimiter).where(sents.str.len() > 0, "")
+        sents = sents.str.insert(0, self.begin_token).str.insert(-1, delimiter + self.end_token)
+
+        token_ids = self._cudf_vocab.tokenize(sents, delimiter=delimiter, default_id=self.unk_id)
+        lengths = token_ids.list.len().to_numpy().astype(np.int64)
+        flat_ids = token_ids.list.leaves.to_numpy().astype(np.int64)
+
+        ids = _pad_flat_ids(flat_ids, lengths, self.pad_id, batch_first)
+        return ids, ids == self.pad_id
+
+    def tokenise_ids(self, sents1, sents2=None, mask=False, batch_first=True, num_threads=1):
+        """ Tokenise a batch of SMILES strings into padded arrays of token ids
+
+        The array equivalent of tokenise(sents1, sents2, mask=mask, pad=True) followed by converting each
+        token output to ids. The tokens are only ever stored as ids, and masking and padding are applied to
+        whole arrays at once. Given the same random state the same tokens are masked as by tokenise.
+
+        Args:
+            sents1 (List[str]): Batch of SMILES strings
+            sents2 (Optional[List[str]]): Batch of second sentences, joined to sents1 with the separator token
+            mask (bool): Whether to mask tokens
+            batch_first (bool): Whether the batch is the first dimension of the output arrays
+            num_threads (int): Maximum number of threads used to split large batches into tokens,
+                               only used when the tokeniser has a compiled scanner
+
+        Returns:
+            Dictionary of arrays with shape (batch_size, seq_len) or (seq_len, batch_size): {
+                "original_ids" (np.ndarray): Token ids, dtype int64,
+                "pad_masks" (np.ndarray): True where the token is padding,
+                "masked_ids" (np.ndarray): Token ids after masking, only if mask is True,
+                "token_masks" (np.ndarray): True where the token was chosen for masking, only if mask is True,
+                "sentence_masks" (np.ndarray): 1 for tokens in the second sentence, only if sents2 is given
+            }
+        """
+
+        if sents2 is not None and len(sents1) != len(sents2):
+            raise ValueError("Sentence 1 batch and sentence 2 batch must have the same number of elements")
+
+        sents = [sents1] if sents2 is None else [sents1, sents2]
+        sent_ids = [self._regex_match_ids(batch, num_threads) for batch in sents]
+        sent_lengths = [lengths for _, lengths in sent_ids]
+
+        # Every output has the same layout: begin, sentence 1, (separator, sentence 2,) end
+        num_rows = len(sents1)
+        ones = np.ones(num_rows, dtype=np.int64)
+
+        def build_rows(begin, sent_values, sep, end):
+            segments = [(np.full(num_rows, begin, dtype=np.int64), ones)]
+            for idx, (values, lengths) in enumerate(zip(sent_values, sent_lengths)):
+                if idx > 0:
+                    segments.append((np.full(num_rows, sep, dtype=np.int64), ones))
+                segments.append((values, lengths))
+            segments.append((np.full(num_rows, end, dtype=np.int64), ones))
+            return self._concat_rows(segments)
+
+        flat_ids, lengths = build_rows(self.begin_id, [ids for ids, _ in sent_ids], self.sep_id, self.end_id)
+        ids = _pad_flat_ids(flat_ids, lengths, self.pad_id, batch_first)
+        output = {
+            "original_ids": ids,
+            "pad_masks": ids == self.pad_id
+        }
+
+        if mask:
+            sent_masked = [self._mask_flat_ids(ids) for ids, _ in sent_ids]
+
+            sent_masked_ids = [masked for masked, _ in sent_masked]
+            flat_masked, _ = build_rows(self.begin_id, sent_masked_ids, self.sep_id, self.end_id)
+            output["masked_ids"] = _pad_flat_ids(flat_masked, lengths, self.pad_id, batch_first)
+
+            token_masks = [token_mask.astype(np.int64) for _, token_mask in sent_masked]
+            flat_token_masks, _ = build_rows(0, token_masks, 0, 0)
+            output["token_masks"] = _pad_flat_ids(flat_token_masks, lengths, 0, batch_first).astype(bool)
+
+        if sents2 is not None:
+            sent_masks = [np.full(len(ids), sent_idx, dtype=np.int64) for sent_idx, (ids, _) in enumerate(sent_ids)]
+            flat_sent_masks, _ = build_rows(0, sent_masks, 0, 1)
+            output["sentence_masks"] = _pad_flat_ids(flat_sent_masks, lengths, 0, batch_first)
+
+        return output
+
+    def _regex_match_ids(self, smiles, num_threads=1):
+        if self._scan_tables is not None:
+            return self._scan_match_ids(smiles, num_threads)
+
+        tokens = self._regex_match(smiles)
+        lengths = np.fromiter(map(len, tokens), dtype=np.int64, count=len(tokens))
+        flat_ids = np.array(self._lookup_ids(list(chain.from_iterable(tokens))), dtype=np.int64)
+        return flat_ids, lengths
+
+    def _scan_match_ids(self, smiles, num_threads):
+        flat_ids, starts, ends, lengths, joined = _tokscan.scan_ids(smiles, self._scan_tables, num_threads)
+
+        # Bracket atoms and unknown tokens are the only ones sliced out of the strings
+        resolve_idxs = np.flatnonzero(flat_ids == _tokscan.RESOLVE_ID)
+        if len(resolve_idxs) > 0:
+            spans = zip(starts[resolve_idxs].tolist(), ends[resolve_idxs].tolist())
+            flat_ids[resolve_idxs] = self._lookup_ids([joined[start:end] for start, end in spans])
+
+        return flat_ids, lengths
+
+    @staticmethod
+    def _concat_rows(segments):
+        """ Join flat segments row by row
+
+        Args:
+            segments (List[Tuple[np.ndarray, np.ndarray]]): Segments to join, each a flat array of values
+                with the number of values in each row
+
+        Returns:
+            flat (np.ndarray): Flat array with the rows of every segment joined in order
+            lengths (np.ndarray): Length of each joined row
+        """
+
+        lengths = sum(seg_lengths for _, seg_lengths in segments)
+        flat = np.empty(lengths.sum(), dtype=np.int64)
+
+        # Position of the next value of each row in the output
+        offsets = np.cumsum(lengths) - lengths
+        for seg_flat, seg_lengths in segments:
+            seg_starts = np.cumsum(seg_lengths) - seg_lengths
+            flat[np.repeat(offsets - seg_starts, seg_lengths) + np.arange(len(seg_flat))] = seg_flat
+            offsets = offsets + seg_lengths
+
+        return flat, lengths
+
+    def _lookup_ids(self, tokens):
+        vocab_get = self._vocab.get
+        token_ids = [vocab_get(token, -1) for token in tokens]
+        if -1 in token_ids:
+            vocab = self._vocab
             for token in tokens:
-                token_id = self.vocab.get(token)
-                if token_id is None:
+                if token not in vocab:
                     self._inc_in_dict(self.unk_token_cnt, token)
 
-            ids = [self.vocab.get(token, self.unk_id) for token in tokens]
-            ids_list.append(ids)
+            token_ids = [self.unk_id if token_id == -1 else token_id for token_id in token_ids]
+
+        return token_ids
+
+    def pad_id_array(self, id_seqs, batch_first=True):
+        """ Pad a batch of token id sequences into a single array
+
+        Args:
+            id_seqs (List[np.ndarray]): Batch of token id sequences
+            batch_first (bool): Whether the batch is the first dimension of the output arrays
+
+        Returns:
+            ids (np.ndarray): Token ids, shape (batch_size, seq_len) or (seq_len, batch_size), dtype int64
+            pad_mask (np.ndarray): True where the token is padding, same shape as ids
+        """
+
+        lengths = np.fromiter(map(len, id_seqs), dtype=np.int64, count=len(id_seqs))
+        flat_ids = np.concatenate(id_seqs).astype(np.int64, copy=False)
+        ids = _pad_flat_ids(flat_ids, lengths, self.pad_id, batch_first)
+
+        pad_mask = ids == self.pad_id
+        return ids, pad_mask
+
+    def mask_id_array(self, id_seqs, batch_first=True):
+        """ Mask and pad a batch of token id sequences which start and end with the begin and end tokens
+
+        The ids are masked directly, so the sequences do not need to be tokenised again.
+        The begin and end tokens are never masked, as in tokenise_ids.
+
+        Args:
+            id_seqs (List[np.ndarray]): Batch of token id sequences, including begin and end tokens
+            batch_first (bool): Whether the batch is the first dimension of the output arrays
+
+        Returns:
+            masked_ids (np.ndarray): Token ids after masking, shape (batch_size, seq_len) or (seq_len, batch_size)
+            pad_mask (np.ndarray): True where the token is padding, same shape as masked_ids
+        """
+
+        lengths = np.fromiter(map(len, id_seqs), dtype=np.int64, count=len(id_seqs))
+        flat_ids = np.concatenate(id_seqs).astype(np.int64)
+
+        ends = np.cumsum(lengths)
+        inner = np.ones(len(flat_ids), dtype=bool)
+        inner[ends - lengths] = False
+        inner[ends - 1] = False
+        flat_ids[inner], _ = self._mask_flat_ids(flat_ids[inner])
 
-        return ids_list
+        masked_ids = _pad_flat_ids(flat_ids, lengths, self.pad_id, batch_first)
+        pad_mask = masked_ids == self.pad_id
+        return masked_ids, pad_mask
 
     def convert_ids_to_tokens(self, token_ids):
+        decode_get = self._decode_vocab.get
         tokens_list = []
         for ids in token_ids:
-            for token_id in ids:
-                token = self.decode_vocab.get(token_id)
-                if token is None:
-                    raise ValueError(f"Token id {token_id} is not recognised")
- 
-            tokens = [self.decode_vocab.get(token_id) for token_id in ids]
+            tokens = [decode_get(token_id) for token_id in ids]
+            if None in tokens:
+                token_id = ids[tokens.index(None)]
+                raise ValueError(f"Token id {token_id} is not recognised")
+
             tokens_list.append(tokens)
 
         return tokens_list
@@ -318,34 +771,82 @@ class MolEncTokeniser:
             mask = [[False] * len(ts) for ts in tokens]
             return tokens, mask
 
-        mask_bools = [True, False]
-        weights = [self.mask_prob, 1 - self.mask_prob]
+        # Draw the mask for every token in the batch at once, then split it back into rows
+        flat_tokens = list(chain.from_iterable(tokens))
+        flat_mask, show_idxs, random_idxs, random_token_idxs = self._draw_masks(len(flat_tokens))
+
+        mask_token = self.mask_token
+        for idx in show_idxs.tolist():
+            flat_tokens[idx] = mask_token
+
+        decode_get = self._decode_vocab.get
+        for idx, token_idx in zip(random_idxs.tolist(), random_token_idxs.tolist()):
+            flat_tokens[idx] = decode_get(token_idx)
+
+        flat_mask = flat_mask.tolist()
 
         masked_tokens = []
         token_masks = []
+        start = 0
         for ts in tokens:
-            token_mask = random.choices(mask_bools, weights=weights, k=len(ts))
-            masked = [self._mask_token(ts[i]) if m else ts[i] for i, m in enumerate(token_mask)]
-            masked_tokens.append(masked)
-            token_masks.append(token_mask)
+            end = start + len(ts)
+            masked_tokens.append(flat_tokens[start:end])
+            token_masks.append(flat_mask[start:end])
+            start = end
 
         return masked_tokens, token_masks
 
-    def _mask_token(self, token):
-        rand = random.random()
-        if rand < self.show_mask_token_prob:
-            return self.mask_token
+    def _mask_flat_ids(self, flat_ids):
+        token_mask, show_idxs, random_idxs, random_token_idxs = self._draw_masks(len(flat_ids))
+        masked = flat_ids.copy()
+        masked[show_idxs] = self.mask_id
+        masked[random_idxs] = random_token_idxs
+        return masked, token_mask
 
-        elif rand < self.show_mask_token_prob + ((1 - self.show_mask_token_prob) / 2):
-            token_idx = random.choice(self.chem_token_idxs)
-            return self.decode_vocab[token_idx]
+    def _draw_masks(self, num_tokens):
+        """ Choose which tokens to mask and what to replace them with
 
-        else:
-            return token
+        Each token is masked with probability mask_prob. A masked token is replaced with the mask token
+        with probability show_mask_token_prob, otherwise it is replaced with a random chemical token or
+        left unchanged with equal probability.
+
+        Args:
+            num_tokens (int): Number of tokens
+
+        Returns:
+            token_mask (np.ndarray): True for tokens which are masked, shape (num_tokens,)
+            show_idxs (np.ndarray): Positions to replace with the mask token
+            random_idxs (np.ndarray): Positions to replace with a random chemical token
+            random_token_idxs (np.ndarray): Vocab index of the token for each position in random_idxs
+        """
+
+        # Draws stay on NumPy's global random state rather than in a compiled kernel, numba keeps a separate
+        # state so masks would no longer follow np.random.seed (eg. in worker_init_fn)
+        token_mask = np.random.random_sample(num_tokens) < self.mask_prob
+        mask_idxs = np.flatnonzero(token_mask)
+        empty = np.zeros(0, dtype=np.int64)
+        if len(mask_idxs) == 0:
+            return token_mask, empty, empty, empty
+
+        rand = np.random.random_sample(len(mask_idxs))
+        show_mask = rand < self.show_mask_token_prob
+        random_token = ~show_mask & (rand < self.show_mask_token_prob + ((1 - self.show_mask_token_prob) / 2))
+
+        random_idxs = mask_idxs[random_token]
+        random_token_idxs = empty
+        if len(random_idxs) > 0:
+            random_token_idxs = np.random.choice(self._chem_token_idx_array, size=len(random_idxs))
+
+        return token_mask, mask_idxs[show_mask], random_idxs, random_token_idxs
 
     @staticmethod
     def _pad_seqs(seqs, pad_token):
-        pad_length = max([len(seq) for seq in seqs])
-        padded = [seq + ([pad_token] * (pad_length - len(seq))) for seq in seqs]
-        masks = [([0] * len(seq)) + ([1] * (pad_length - len(seq))) for seq in seqs]
+        lengths = list(map(len, seqs))
+        pad_length = max(lengths)
+
+        # Each row is a single slice of a template, rather than building and joining two lists per row
+        pads = [pad_token] * pad_length
+        mask_row = ([0] * pad_length) + ([1] * pad_length)
+        padded = [seq + pads[length:] for seq, length in zip(seqs, lengths)]
+        masks = [mask_row[pad_length - length:(2 * pad_length) - length] for length in lengths]
         return padded, masks
@@ -1,4 +1,5 @@
 import argparse
+import torch
 from pytorch_lightning import Trainer
 
 import molbart.util as util
@@ -18,6 +19,8 @@ DEFAULT_TRAIN_TOKENS = None
 DEFAULT_NUM_BUCKETS = 12
 DEFAULT_LIMIT_VAL_BATCHES = 1.0
 DEFAULT_AUGMENT = True
+DEFAULT_COMPILE = False
+DEFAULT_TOKEN_CACHE_DIR = None
 
 
 def build_model(args, sampler, vocab_size, total_steps, pad_token_idx):
@@ -53,9 +56,26 @@ def build_model(args, sampler, vocab_size, total_steps, pad_token_idx):
     else:
         raise ValueError(f"Unknown model type {args.model_type}")
 
+    if args.compile:
+        compile_model(model)
+
     return model
 
 
+def compile_model(model):
+    """ Compile the forward of the transformer encoder and decoder with torch.compile
+
+    The forward methods are replaced in place, rather than wrapping the modules, so the parameter
+    names in checkpoints do not change. Shapes are marked dynamic since batches vary in sequence length.
+    """
+
+    if not hasattr(torch, "compile"):
+        raise ValueError(f"torch.compile is not available in torch version {torch.__version__}")
+
+    for module in [model.encoder, model.decoder]:
+        module.forward = torch.compile(module.forward, dynamic=True)
+
+
 def main(args):
     print("Building tokeniser...")
     tokeniser = util.load_tokeniser(args.vocab_path, args.chem_token_start_idx)
@@ -124,6 +144,11 @@ if __name__ == "__main__":
     parser.add_argument("--augment", dest="augment", action="store_true")
     parser.add_argument("--no_augment", dest="augment", action="store_false")
     parser.set_defaults(augment=DEFAULT_AUGMENT)
+    parser.add_argument("--token_cache_dir", type=str, default=DEFAULT_TOKEN_CACHE_DIR)
+
+    parser.add_argument("--compile", dest="compile", action="store_true")
+    parser.add_argument("--no_compile", dest="compile", action="store_false")
+    parser.set_defaults(compile=DEFAULT_COMPILE)
 
     args = parser.parse_args()
     main(args)
@@ -23,7 +23,8 @@ DEFAULT_DROPOUT = 0.1
 
 DEFAULT_VOCAB_PATH = "bart_vocab.txt"
 DEFAULT_CHEM_TOKEN_START = 272
-REGEX = "\[[^\]]+]|Br?|Cl?|N|O|S|P|F|I|b|c|n|o|s|p|\(|\)|\.|=|#|-|\+|\\\\|\/|:|~|@|\?|>|\*|\$|\%[0-9]{2}|[0-9]"
+# Single character tokens share one character class, so they are checked with a single set lookup
+REGEX = r"\[[^\]]+]|Br?|Cl?|[NOSPFIbcnops()=#\-+\\/:~@?>*$.]|\%[0-9]{2}|[0-9]"
 
 USE_GPU = True
 use_gpu = USE_GPU and torch.cuda.is_available()
@@ -55,7 +56,8 @@ def build_molecule_datamodule(args, dataset, tokeniser):
         train_token_batch_size=args.train_tokens,
         num_buckets=args.num_buckets,
         val_idxs=dataset.val_idxs,
-        test_idxs=dataset.test_idxs
+        test_idxs=dataset.test_idxs,
+        token_cache_dir=args.token_cache_dir
     )
     return dm
 
@@ -76,8 +78,8 @@ def build_reaction_datamodule(args, dataset, tokeniser):
     return dm
 
 
-def load_tokeniser(vocab_path, chem_token_start):
-    tokeniser = MolEncTokeniser.from_vocab_file(vocab_path, REGEX, chem_token_start)
+def load_tokeniser(vocab_path, chem_token_start, cache_tokens=False):
+    tokeniser = MolEncTokeniser.from_vocab_file(vocab_path, REGEX, chem_token_start, cache_tokens=cache_tokens)
     return tokeniser
 
 
@@ -0,0 +1,129 @@
+import torch
+import pytest
+import numpy as np
+
+from molbart.data.util import DistTokenSampler, PrefetchLoader, TokenSampler
+
+
+class _FailingLoader:
+    def __init__(self, num_batches):
+        self.num_batches = num_batches
+
+    def __iter__(self):
+        for idx in range(self.num_batches):
+            yield idx
+        raise RuntimeError("Failed to load batch")
+
+
+def test_prefetch_loader_order_and_count():
+    loader = torch.utils.data.DataLoader(list(range(10)), batch_size=3)
+    prefetch_loader = PrefetchLoader(loader, prefetch=2)
+    batches = [batch.tolist() for batch in prefetch_loader]
+    expected = [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
+
+    assert expected == batches
+    assert len(expected) == len(prefetch_loader)
+
+    # The loader can be iterated again, eg. for the next epoch
+    assert expected == [batch.tolist() for batch in prefetch_loader]
+
+
+def test_prefetch_loader_raises_loader_error():
+    batches = []
+    with pytest.raises(RuntimeError, match="Failed to load batch"):
+        for batch in PrefetchLoader(_FailingLoader(3), prefetch=1):
+            batches.append(batch)
+
+    assert [0, 1, 2] == batches
+
+
+def test_prefetch_loader_stops_thread_on_break():
+    prefetch_loader = PrefetchLoader(list(range(100)), prefetch=1)
+    batches = []
+    for batch in prefetch_loader:
+        batches.append(batch)
+        break
+
+    # The generator is closed as soon as the loop exits, which stops and joins the producer thread
+    assert [0] == batches
+    assert not prefetch_loader._thread.is_alive()
+
+
+def test_prefetch_loader_pins_batches():
+    if not torch.cuda.is_available():
+        pytest.skip("Pinning memory requires CUDA")
+
+    loader = [{"ids": torch.arange(4)}, {"ids": torch.arange(2)}]
+    batches = list(PrefetchLoader(loader, pin_memory=True))
+
+    assert all(batch["ids"].is_pinned() for batch in batches)
+
+
+def test_token_sampler_yields_each_index_once():
+    # Both buckets split exactly into batches of 60 tokens, so no indices are dropped
+    seq_lengths = np.random.RandomState(0).permutation([10] * 12 + [20] * 9)
+    sampler = TokenSampler(2, seq_lengths, 60)
+    batches = list(sampler)
+    idxs = [idx for batch in batches for idx in batch]
+
+    assert sorted(idxs) == list(range(len(seq_lengths)))
+    assert len(batches) == len(sampler)
+    assert all(seq_lengths[batch].sum() == 60 for batch in batches)
+
+
+def test_token_sampler_batches_within_batch_size():
+    seq_lengths = np.random.RandomState(0).randint(5, 60, size=500)
+    sampler = TokenSampler(4, seq_lengths, 200)
+    batches = list(sampler)
+    idxs = [idx for batch in batches for idx in batch]
+
+    assert len(idxs) == len(set(idxs))
+    assert len(batches) == len(sampler)
+
+    # Every batch is taken from one bucket and holds about batch_size tokens at the bucket's average length
+    bucket_of_idx = {idx: b_idx for b_idx, bucket in enumerate(sampler.buckets) for idx in bucket.tolist()}
+    for batch in batches:
+        bucket_ids = set(bucket_of_idx[idx] for idx in batch)
+        assert len(bucket_ids) == 1
+
+        bucket = sampler.buckets[bucket_ids.pop()]
+        assert len(batch) * (seq_lengths[bucket].sum() // len(bucket)) <= 200
+
+    # At most one partial batch is dropped from each bucket
+    for bucket, num_seqs in zip(sampler.buckets, sampler.num_seqs):
+        if num_seqs > 0:
+            assert len(set(bucket.tolist()) - set(idxs)) < num_seqs
+
+
+def _dist_token_samplers(world_size, seed=0):
+    seq_lengths = np.random.RandomState(0).randint(5, 60, size=500)
+    return [DistTokenSampler(4, seq_lengths, 200, rank, world_size, seed=seed) for rank in range(world_size)]
+
+
+def test_dist_token_sampler_shards_disjoint():
+    samplers = _dist_token_samplers(3)
+    rank_idxs = [set(idx for batch in sampler for idx in batch) for sampler in samplers]
+
+    assert all(len(idxs) > 0 for idxs in rank_idxs)
+    assert len(rank_idxs[0] & rank_idxs[1]) == 0
+    assert len(rank_idxs[0] & rank_idxs[2]) == 0
+    assert len(rank_idxs[1] & rank_idxs[2]) == 0
+
+
+def test_dist_token_sampler_length_equal_on_ranks():
+    samplers = _dist_token_samplers(3)
+    num_batches = [len(list(sampler)) for sampler in samplers]
+
+    assert len(set(len(sampler) for sampler in samplers)) == 1
+    assert [len(sampler) for sampler in samplers] == num_batches
+
+
+def test_dist_token_sampler_set_epoch_changes_order():
+    sampler = _dist_token_samplers(2)[0]
+    epoch_0 = list(sampler)
+    assert epoch_0 == list(sampler)
+
+    sampler.set_epoch(1)
+    epoch_1 = list(sampler)
+
+    assert epoch_0 != epoch_1
@@ -0,0 +1,98 @@
+import pytest
+import numpy as np
+from rdkit import Chem
+
+from molbart import _tokscan
+from molbart.tokeniser import MolEncTokeniser
+from molbart.data.datasets import MoleculeDataset
+from molbart.data.datamodules import MoleculeDataModule
+
+
+regex = "\[[^\]]+]|Br?|Cl?|N|O|S|P|F|I|b|c|n|o|s|p|\(|\)|\.|=|#|-|\+|\\\\|\/|:|~|@|\?|>|\*|\$|\%[0-9]{2}|[0-9]"
+
+# Use dummy SMILES strings
+smiles_data = [
+    "CCO",
+    "c1ccccc1Cl",
+    "C(=O)CBr",
+    "[NH4+].[Cl-]",
+    "CC(C)(C)OC(=O)N"
+]
+
+canonical_smiles = [Chem.MolToSmiles(Chem.MolFromSmiles(smi), canonical=True) for smi in smiles_data]
+
+
+def _build_dataset():
+    mols = [Chem.MolFromSmiles(smi) for smi in smiles_data]
+    return MoleculeDataset(mols)
+
+
+def _build_datamodule(dataset, max_seq_len=40):
+    tokeniser = MolEncTokeniser.from_smiles(canonical_smiles, regex, mask_prob=0.4)
+    return MoleculeDataModule(dataset, tokeniser, 2, max_seq_len, augment=False)
+
+
+def test_precompute_ids_matches_tokenise_to_ids():
+    tokeniser = MolEncTokeniser.from_smiles(canonical_smiles, regex)
+    dataset = _build_dataset()
+    dataset.precompute_ids(tokeniser, chunk_size=2)
+
+    ids, pad_mask = tokeniser.tokenise_to_ids(canonical_smiles)
+    expected = [row[~row_mask].tolist() for row, row_mask in zip(ids, pad_mask)]
+
+    assert expected == [dataset[idx].tolist() for idx in range(len(dataset))]
+    assert dataset.token_ids.dtype == np.int16
+    assert dataset.token_offsets.tolist() == np.cumsum([0] + [len(row) for row in expected]).tolist()
+
+
+def test_precompute_ids_threaded_matches_single_thread(monkeypatch):
+    monkeypatch.setattr(_tokscan, "MIN_CHUNK_SIZE", 1)
+
+    tokeniser = MolEncTokeniser.from_smiles(canonical_smiles, regex)
+    dataset = _build_dataset()
+    dataset.precompute_ids(tokeniser)
+    threaded_dataset = _build_dataset()
+    threaded_dataset.precompute_ids(tokeniser, num_threads=3)
+
+    assert dataset.token_ids.tolist() == threaded_dataset.token_ids.tolist()
+    assert dataset.token_offsets.tolist() == threaded_dataset.token_offsets.tolist()
+
+
+def test_precompute_ids_cache_round_trip(tmp_path):
+    tokeniser = MolEncTokeniser.from_smiles(canonical_smiles, regex)
+    dataset = _build_dataset()
+    dataset.precompute_ids(tokeniser, cache_dir=tmp_path)
+
+    assert (tmp_path / "ids.npy").exists()
+    assert (tmp_path / "offsets.npy").exists()
+
+    # Cached ids are loaded without tokenising, so no tokeniser is needed
+    cached_dataset = _build_dataset()
+    cached_dataset.precompute_ids(None, cache_dir=tmp_path)
+
+    assert isinstance(cached_dataset.token_ids, np.memmap)
+    for idx in range(len(dataset)):
+        assert dataset[idx].tolist() == cached_dataset[idx].tolist()
+
+
+@pytest.mark.parametrize("train", [True, False])
+@pytest.mark.parametrize("max_seq_len", [40, 6])
+def test_collate_ids_matches_collate_mols(train, max_seq_len):
+    mol_dm = _build_datamodule(_build_dataset(), max_seq_len)
+    id_dataset = _build_dataset()
+    id_dm = _build_datamodule(id_dataset, max_seq_len)
+    id_dataset.precompute_ids(id_dm.tokeniser)
+
+    mols = [Chem.MolFromSmiles(smi) for smi in smiles_data]
+    np.random.seed(0)
+    expected = mol_dm._collate(mols, train=train)
+    np.random.seed(0)
+    output = id_dm._collate([id_dataset[idx] for idx in range(len(id_dataset))], train=train)
+
+    assert expected["target_smiles"] == output["target_smiles"]
+    for key, value in expected.items():
+        if key != "target_smiles":
+            assert value.tolist() == output[key].tolist()
+
+    if max_seq_len == 6:
+        assert output["encoder_input"].shape[0] == 6
@@ -1,7 +1,10 @@
 import torch
+import pickle
 import pytest
 import random
+import numpy as np
 
+from molbart import _tokscan
 from molbart.tokeniser import MolEncTokeniser
 
 
@@ -20,6 +23,7 @@ example_tokens = [
 ]
 
 random.seed(a=1)
+np.random.seed(1)
 
 
 def test_create_vocab():
@@ -47,6 +51,50 @@ def test_create_vocab():
     assert expected == vocab
 
 
+def test_vocab_read_only_and_picklable():
+    tokeniser = MolEncTokeniser.from_smiles(smiles_data, regex)
+    with pytest.raises(TypeError):
+        tokeniser.vocab["Se"] = 15
+
+    unpickled = pickle.loads(pickle.dumps(tokeniser))
+
+    assert unpickled.vocab == tokeniser.vocab
+    assert unpickled.convert_ids_to_tokens([[2, 14, 3]]) == [["^", "Br", "&"]]
+
+
+def test_unpickle_baseline_state():
+    tokeniser = MolEncTokeniser.from_smiles(smiles_data, regex)
+    vocab = dict(tokeniser.vocab)
+
+    # State of a tokeniser pickled before the vocab views and token ids were added
+    state = {
+        "vocab": vocab,
+        "decode_vocab": {i: t for t, i in vocab.items()},
+        "chem_token_idxs": tokeniser.chem_token_idxs,
+        "prog": tokeniser.prog,
+        "begin_token": "^",
+        "end_token": "&",
+        "pad_token": "<PAD>",
+        "unk_token": "?",
+        "mask_token": "<MASK>",
+        "sep_token": "<SEP>",
+        "mask_prob": 0.15,
+        "show_mask_token_prob": 0.8,
+        "unk_id": 1,
+        "unk_token_cnt": {}
+    }
+    unpickled = MolEncTokeniser.__new__(MolEncTokeniser)
+    unpickled.__setstate__(state)
+
+    assert unpickled.vocab == tokeniser.vocab
+    assert (unpickled.pad_id, unpickled.begin_id, unpickled.end_id) == (0, 2, 3)
+    assert not unpickled.cache_tokens
+    assert unpickled._scan_tables is None
+    assert unpickled._chem_token_idx_array.tolist() == tokeniser.chem_token_idxs
+    assert unpickled.tokenise_ids(smiles_data, mask=True)["original_ids"].tolist() == \
+        tokeniser.tokenise_to_ids(smiles_data)[0].tolist()
+
+
 def test_pad_seqs_padding():
     seqs = [[1,2], [2,3,4,5], []]
     padded, _ = MolEncTokeniser._pad_seqs(seqs, " ")
@@ -80,8 +128,8 @@ def test_mask_tokens_masking():
     masked, token_mask = tokeniser._mask_tokens(example_tokens)
 
     expected_masks = [
-        [True, False, False, True, False, False, False, False],
-        [False, False, False, True, False, False, True]
+        [False, False, True, True, True, True, True, True],
+        [True, False, False, False, True, False, True]
     ]
 
     assert expected_masks == token_mask
@@ -95,6 +143,169 @@ def test_convert_tokens_to_ids():
     assert expected_ids == ids
 
 
+def test_convert_tokens_to_id_array():
+    tokeniser = MolEncTokeniser.from_smiles(smiles_data[2:3], regex)
+    ids, pad_mask = tokeniser.convert_tokens_to_id_array(example_tokens)
+    expected_ids = [[2, 6, 7, 8, 9, 10, 1, 3], [2, 6, 6, 5, 6, 11, 3, 0]]
+    expected_mask = [([False] * 8), ([False] * 7) + [True]]
+
+    assert expected_ids == ids.tolist()
+    assert expected_mask == pad_mask.tolist()
+
+
+def test_convert_tokens_to_id_array_seq_first():
+    tokeniser = MolEncTokeniser.from_smiles(smiles_data[2:3], regex)
+    ids, pad_mask = tokeniser.convert_tokens_to_id_array(example_tokens, batch_first=False)
+    expected_ids = [[2, 6, 7, 8, 9, 10, 1, 3], [2, 6, 6, 5, 6, 11, 3, 0]]
+
+    assert ids.shape == (8, 2)
+    assert expected_ids == ids.T.tolist()
+    assert pad_mask.T.tolist()[1][-1]
+
+
+def test_tokenise_to_ids():
+    tokeniser = MolEncTokeniser.from_smiles(smiles_data, regex)
+    tokens = tokeniser.tokenise(smiles_data, pad=True)["original_tokens"]
+    expected_ids, expected_mask = tokeniser.convert_tokens_to_id_array(tokens)
+    ids, pad_mask = tokeniser.tokenise_to_ids(smiles_data)
+
+    assert expected_ids.tolist() == ids.tolist()
+    assert expected_mask.tolist() == pad_mask.tolist()
+
+
+@pytest.mark.parametrize("batch_first", [True, False])
+def test_tokenise_cudf_matches_tokenise_to_ids(batch_first):
+    pytest.importorskip("cudf")
+
+    extra_tokens = ["Clint_low->high", "<RESERVED>"]
+    tokeniser = MolEncTokeniser.from_smiles(smiles_data, regex, extra_tokens=extra_tokens)
+    smiles = smiles_data + ["", "[NH4+]Clint_low->highCl", "C<RESERVED>[Se]"]
+
+    expected_ids, expected_mask = tokeniser.tokenise_to_ids(smiles, batch_first=batch_first)
+    ids, pad_mask = tokeniser.tokenise_cudf(smiles, batch_first=batch_first)
+
+    assert expected_ids.tolist() == ids.tolist()
+    assert expected_mask.tolist() == pad_mask.tolist()
+
+
+def test_tokenise_ids_two_sentences():
+    tokeniser = MolEncTokeniser.from_smiles(smiles_data, regex)
+    output = tokeniser.tokenise_ids(smiles_data[1:], sents2=smiles_data[:2])
+    expected = tokeniser.tokenise(smiles_data[1:], sents2=smiles_data[:2], pad=True)
+
+    assert tokeniser.convert_tokens_to_ids(expected["original_tokens"]) == output["original_ids"].tolist()
+    assert expected["pad_masks"] == output["pad_masks"].astype(int).tolist()
+    assert expected["sentence_masks"] == output["sentence_masks"].tolist()
+
+
+def test_tokenise_ids_mask_matches_tokenise():
+    tokeniser = MolEncTokeniser.from_smiles(smiles_data, regex, mask_prob=0.4)
+    np.random.seed(0)
+    expected = tokeniser.tokenise(smiles_data, mask=True, pad=True)
+    np.random.seed(0)
+    output = tokeniser.tokenise_ids(smiles_data, mask=True, batch_first=False)
+
+    assert tokeniser.convert_tokens_to_ids(expected["masked_tokens"]) == output["masked_ids"].T.tolist()
+    assert expected["token_masks"] == output["token_masks"].T.tolist()
+
+
+def test_tokenise_ids_scanner_matches_regex():
+    pytest.importorskip("numba")
+
+    extra_tokens = ["Clint_low->high", "<RESERVED>"]
+    tokeniser = MolEncTokeniser.from_smiles(smiles_data, regex, extra_tokens=extra_tokens)
+    smiles = smiles_data + ["Clint_low->highCCl", "[NH4+][Se]Br%12c1", "[]C[", "B<RESERVED>Xé"]
+
+    output = tokeniser.tokenise_ids(smiles, smiles[::-1])
+    tokeniser._scan_tables = None
+    expected = tokeniser.tokenise_ids(smiles, smiles[::-1])
+
+    for key, value in expected.items():
+        assert value.tolist() == output[key].tolist()
+
+
+def test_tokenise_ids_threaded_matches_single_thread(monkeypatch):
+    pytest.importorskip("numba")
+    monkeypatch.setattr(_tokscan, "MIN_CHUNK_SIZE", 2)
+
+    tokeniser = MolEncTokeniser.from_smiles(smiles_data, regex)
+    smiles = smiles_data * 3 + ["[NH4+]", ""]
+    expected = tokeniser.tokenise_ids(smiles)
+    output = tokeniser.tokenise_ids(smiles, num_threads=3)
+
+    for key, value in expected.items():
+        assert value.tolist() == output[key].tolist()
+
+
+def test_tokenise_regex_matches_legacy_regex():
+    smiles = smiles_data + ["[NH4+].[Cl-]", "C%12CC%12", "c1ccc(/C=C\\Br)o1", "[]C[é#"]
+    tokeniser = MolEncTokeniser.from_smiles(smiles, _tokscan.REGEX)
+    legacy_tokeniser = MolEncTokeniser.from_smiles(smiles, regex)
+
+    assert tokeniser.tokenise(smiles) == legacy_tokeniser.tokenise(smiles)
+    assert (tokeniser._scan_tables is not None) == (legacy_tokeniser._scan_tables is not None)
+
+
+def test_tokenise_cached_tokens():
+    expected = MolEncTokeniser.from_smiles(smiles_data, regex).tokenise(smiles_data, sents2=smiles_data, pad=True)
+    tokeniser = MolEncTokeniser.from_smiles(smiles_data, regex, cache_tokens=True)
+    tokeniser.tokenise(smiles_data, sents2=smiles_data, pad=True)
+    output = tokeniser.tokenise(smiles_data, sents2=smiles_data, pad=True)
+
+    assert expected == output
+
+
+def test_has_scanner():
+    tokeniser = MolEncTokeniser.from_smiles(smiles_data, regex)
+    other_regex_tokeniser = MolEncTokeniser.from_smiles(smiles_data, "C|O")
+
+    assert tokeniser.has_scanner == (_tokscan.njit is not None)
+    assert not other_regex_tokeniser.has_scanner
+
+
+def test_pad_id_array():
+    tokeniser = MolEncTokeniser.from_smiles(smiles_data, regex)
+    ids, pad_mask = tokeniser.pad_id_array([[2, 6, 3], [2, 6, 7, 8, 3]])
+    expected_ids = [[2, 6, 3, 0, 0], [2, 6, 7, 8, 3]]
+    expected_mask = [[False, False, False, True, True], [False] * 5]
+
+    assert expected_ids == ids.tolist()
+    assert expected_mask == pad_mask.tolist()
+
+
+def test_pad_id_array_seq_first():
+    tokeniser = MolEncTokeniser.from_smiles(smiles_data, regex)
+    ids, pad_mask = tokeniser.pad_id_array([np.array([2, 6, 3]), np.array([2, 6, 7, 8, 3])], batch_first=False)
+    expected_ids = [[2, 2], [6, 6], [3, 7], [0, 8], [0, 3]]
+
+    assert expected_ids == ids.tolist()
+    assert ids.flags["C_CONTIGUOUS"]
+    assert [[False, False]] * 3 + [[True, False]] * 2 == pad_mask.tolist()
+
+
+def test_mask_id_array_matches_tokenise_ids():
+    tokeniser = MolEncTokeniser.from_smiles(smiles_data, regex, mask_prob=0.4)
+    ids, pad_mask = tokeniser.tokenise_to_ids(smiles_data)
+    id_seqs = [row[~row_mask] for row, row_mask in zip(ids, pad_mask)]
+
+    np.random.seed(0)
+    expected = tokeniser.tokenise_ids(smiles_data, mask=True, batch_first=False)
+    np.random.seed(0)
+    masked_ids, masked_pad_mask = tokeniser.mask_id_array(id_seqs, batch_first=False)
+
+    assert expected["masked_ids"].tolist() == masked_ids.tolist()
+    assert expected["pad_masks"].tolist() == masked_pad_mask.tolist()
+
+
+def test_tokenise_extra_tokens():
+    extra_tokens = ["<A>", "LogD_(0.1]", "<AB>", "<A"]
+    tokeniser = MolEncTokeniser.from_smiles(smiles_data, regex, extra_tokens=extra_tokens)
+    tokens = tokeniser.tokenise(["C<AB>LogD_(0.1]C<A><ACl"])
+    expected = [["^", "C", "<AB>", "LogD_(0.1]", "C", "<A>", "<A", "Cl", "&"]]
+
+    assert expected == tokens["original_tokens"]
+
+
 def test_tokenise_one_sentence():
     tokeniser = MolEncTokeniser.from_smiles(smiles_data, regex)
     tokens = tokeniser.tokenise(smiles_data)
@@ -130,9 +341,9 @@ def test_tokenise_mask():
     tokeniser = MolEncTokeniser.from_smiles(smiles_data, regex, mask_prob=0.4)
     tokens = tokeniser.tokenise(smiles_data, sents2=smiles_data, mask=True)
     expected_m_tokens = [
-        ["^", "<MASK>", "<MASK>", "O", ".", "<MASK>", "<MASK>", "c", "<SEP>", "C", "C", "<MASK>", ")", "C", "c", "c", "&"],
-        ["^", "<MASK>", "Br", "Cl", "C", "<MASK>", "<SEP>", "<MASK>", "C", "Cl", "<MASK>", "Cl", "&"],
-        ["^", "C", "(", "=", "O", ")", "C", "Br", "<SEP>", "<MASK>", "(", "=", "O", ")", "<MASK>", "Br", "&"]
+        ["^", "C", "C", "O", "<MASK>", "<MASK>", "c", "c", "<SEP>", "C", "C", "O", "<MASK>", "C", "c", "c", "&"],
+        ["^", "C", "C", "<MASK>", "<MASK>", "Cl", "<SEP>", "C", "<MASK>", ".", "C", "Cl", "&"],
+        ["^", "C", "(", "<MASK>", "O", ")", "<MASK>", "Br", "<SEP>", "C", "(", "=", "<MASK>", "<MASK>", "C", "<MASK>", "&"]
     ]
     expected_tokens = [
         ["^", "C", "C", "O", ".", "C", "c", "c", "<SEP>", "C", "C", "O", ".", "C", "c", "c", "&"],